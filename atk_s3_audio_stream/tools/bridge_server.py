@@ -1,51 +1,107 @@
 #!/usr/bin/env python3
 import asyncio
+import collections
+import functools
 import websockets
-import threading
-from http.server import SimpleHTTPRequestHandler, HTTPServer
+from aiohttp import web
 import os
+import socket
 import struct
+import sys
 
 # Ports
 HTTP_PORT = int(os.getenv('HTTP_PORT', '9000'))
 WS_PORT = int(os.getenv('WS_PORT', '9001'))
 TCP_PORT = int(os.getenv('TCP_PORT', '9002'))
+WEBROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'www')
 
 PCM_MAGIC = 0x304D4350  # 'PCM0'
+PCM_HDR = struct.Struct('<IBH')  # magic, type, payload length
+PCM_HDR_DOWN = struct.pack('<IB', PCM_MAGIC, 0x02)  # constant part of the downlink header
+READ_CHUNK = 64 * 1024  # max bytes pulled from the board stream per read
+CLIENT_QUEUE_SIZE = 64  # uplink frames buffered per websocket client
 
-# Global state
-clients = set()  # websocket clients
-board_writer = None  # asyncio StreamWriter to ESP32 board (downlink)
+class BridgeState:
+    """Connection state shared by the WS and TCP handlers; created inside the running loop."""
 
-async def ws_handler(websocket):
-    global board_writer
-    clients.add(websocket)
+    def __init__(self):
+        self.clients = {}  # websocket client -> (outbound deque, asyncio.Event)
+        self.board_writer = None  # asyncio StreamWriter to ESP32 board (downlink)
+        self.board_lock = asyncio.Lock()  # serializes downlink write+drain across WS clients
+
+async def _relay(websocket, pending: collections.deque, ready: asyncio.Event):
+    # Drain one client's backlog so a slow socket never stalls the uplink loop
+    try:
+        while True:
+            await ready.wait()
+            ready.clear()
+            while pending:
+                await websocket.send(pending.popleft())
+    except Exception:
+        pass
+
+def _enqueue(outbox, payload):
+    # A full deque drops its oldest frame on append: freshness matters more than
+    # completeness for live audio, and no exception is raised on the hot path
+    pending, ready = outbox
+    pending.append(payload)
+    ready.set()
+
+async def ws_handler(state: BridgeState, websocket):
+    outbox = (collections.deque(maxlen=CLIENT_QUEUE_SIZE), asyncio.Event())
+    relay = asyncio.create_task(_relay(websocket, *outbox))
+    state.clients[websocket] = outbox
     try:
         async for message in websocket:
-            # Expect binary PCM 24k/16bit mono from browser mic; forward to board
+            # Expect binary PCM 24k/16bit mono from browser mic; forward to board.
+            # Frames are dropped while no board is connected: stale mic audio is useless.
             if isinstance(message, (bytes, bytearray)):
-                if board_writer is not None:
-                    hdr = struct.pack('<IBH', PCM_MAGIC, 0x02, len(message))
+                writer = state.board_writer
+                if writer is not None:
+                    hdr = PCM_HDR_DOWN + len(message).to_bytes(2, 'little')
                     try:
-                        board_writer.write(hdr)
-                        board_writer.write(message)
-                        await board_writer.drain()
+                        async with state.board_lock:
+                            # Header and payload go out in one transport write
+                            writer.writelines((hdr, message))
+                            await writer.drain()
                     except Exception:
                         pass
     finally:
-        clients.discard(websocket)
+        state.clients.pop(websocket, None)
+        relay.cancel()
 
-async def ws_server():
-    async with websockets.serve(ws_handler, '0.0.0.0', WS_PORT, max_size=None, ping_interval=None):
+async def ws_server(state: BridgeState):
+    # Raw PCM barely compresses, so permessage-deflate is disabled
+    async with websockets.serve(functools.partial(ws_handler, state), '0.0.0.0', WS_PORT, max_size=None, max_queue=16, ping_interval=None,
+                                compression=None):
         print(f"[WS] WebSocket server on ws://0.0.0.0:{WS_PORT}")
         await asyncio.Future()
 
-async def tcp_board_server():
+def _tune_board_socket(sock):
+    # Small realtime packets: disable Nagle and give the kernel room to absorb bursts
+    if sock is None:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        if hasattr(socket, 'TCP_QUICKACK'):  # Linux only
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+    except OSError as e:
+        print(f"[TCP] setsockopt failed: {e}")
+
+async def _read_into(reader: asyncio.StreamReader, buf: bytearray):
+    # Append everything the stream has buffered (up to READ_CHUNK) in a single await
+    chunk = await reader.read(READ_CHUNK)
+    if not chunk:
+        raise asyncio.IncompleteReadError(bytes(buf), None)
+    buf += chunk
+
+async def tcp_board_server(state: BridgeState):
     async def handle_board(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        global board_writer
         peer = writer.get_extra_info('peername')
         print(f"[TCP] Board connected: {peer}")
-        board_writer = writer
+        _tune_board_socket(writer.get_extra_info('socket'))
         # Robust hello detection (read 8 first for HELLO-UP, else try HELLO-DOWN 10 bytes)
         try:
             hello8 = await reader.readexactly(8)
@@ -57,25 +113,37 @@ async def tcp_board_server():
         try:
             if hello8 == b"HELLO-UP":  # uplink connection (from board mic)
                 print("[TCP] Uplink channel")
+                buf = bytearray()
                 while True:
-                    hdr = await reader.readexactly(7)  # <IBH
-                    magic, ptype, length = struct.unpack('<IBH', hdr)
+                    # Header and payload usually arrive together, so one read normally covers both
+                    while len(buf) < PCM_HDR.size:
+                        await _read_into(reader, buf)
+                    magic, ptype, length = PCM_HDR.unpack_from(buf, 0)
                     if magic != PCM_MAGIC or ptype != 0x01 or length == 0:
                         print(f"[TCP] Bad header magic={magic:x} type={ptype} len={length}")
                         break
-                    payload = await reader.readexactly(length)
-                    if clients:
-                        await asyncio.gather(*(c.send(payload) for c in list(clients)))
+                    end = PCM_HDR.size + length
+                    while len(buf) < end:
+                        await _read_into(reader, buf)
+                    # Copy straight out of a view (slicing the bytearray would copy twice);
+                    # the view must be released before the bytearray can be resized
+                    with memoryview(buf) as mv:
+                        payload = bytes(mv[PCM_HDR.size:end])
+                    del buf[:end]
+                    for outbox in state.clients.values():  # no await inside, safe to iterate live
+                        _enqueue(outbox, payload)
             else:
                 extra = await reader.readexactly(2)  # to form 10 bytes
                 hello10 = hello8 + extra
                 if hello10 == b"HELLO-DOWN":  # downlink connection (to board speaker)
                     print("[TCP] Downlink channel")
-                    # keep writer globally to forward WS mic to board
-                    board_writer = writer
-                    # keep connection open
-                    while True:
-                        await asyncio.sleep(1)
+                    # keep writer in shared state to forward WS mic to board
+                    state.board_writer = writer
+                    # Park until the board closes the socket (read returns b'' on EOF);
+                    # nothing is expected on this channel, so stray bytes are discarded
+                    while await reader.read(READ_CHUNK):
+                        pass
+                    print("[TCP] Board disconnected")
                 else:
                     print(f"[TCP] Unknown hello: {hello8 + extra}")
         except asyncio.IncompleteReadError:
@@ -92,8 +160,8 @@ async def tcp_board_server():
                 await writer.wait_closed()
             except Exception:
                 pass
-            if board_writer is writer:
-                board_writer = None
+            if state.board_writer is writer:
+                state.board_writer = None
 
     server = await asyncio.start_server(handle_board, '0.0.0.0', TCP_PORT)
     addrs = ', '.join(str(sock.getsockname()) for sock in server.sockets)
@@ -101,25 +169,37 @@ async def tcp_board_server():
     async with server:
         await server.serve_forever()
 
-class SPAHandler(SimpleHTTPRequestHandler):
-    def translate_path(self, path):
-        # Serve files from tools/www
-        webroot = os.path.join(os.path.dirname(__file__), 'www')
-        if path == '/' or path == '':
-            path = '/index.html'
-        return os.path.join(webroot, path.lstrip('/'))
+async def http_server():
+    # Serve the SPA from tools/www on the same event loop (static files go out via sendfile)
+    app = web.Application()
+
+    async def index(request):
+        return web.FileResponse(os.path.join(WEBROOT, 'index.html'))
 
-def http_thread():
-    httpd = HTTPServer(('0.0.0.0', HTTP_PORT), SPAHandler)
+    app.router.add_get('/', index)
+    app.router.add_static('/', WEBROOT)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '0.0.0.0', HTTP_PORT)
+    await site.start()
     print(f"[HTTP] Serving http://0.0.0.0:{HTTP_PORT}")
-    httpd.serve_forever()
+    try:
+        await asyncio.Future()
+    finally:
+        await runner.cleanup()
 
 async def async_main():
-    t = threading.Thread(target=http_thread, daemon=True)
-    t.start()
-    await asyncio.gather(ws_server(), tcp_board_server())
+    state = BridgeState()
+    await asyncio.gather(http_server(), ws_server(state), tcp_board_server(state))
 
 def main():
+    # uvloop is optional and POSIX-only; fall back to the default loop otherwise
+    if sys.platform != 'win32':
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            pass
     asyncio.run(async_main())
 
 if __name__ == '__main__':
@@ -27,6 +27,7 @@
 #define LWIP_DEMO_RX_BUFSIZE         128                        /* 最大接收数据长度 */
 #define LWIP_DEMO_PORT               8000                       /* 连接的本地端口号 */
 #define LWIP_SEND_THREAD_PRIO        10                         /* 发送数据线程优先级 */
+#define LWIP_DEMO_LENGTH_PREFIX      0                          /* 1: 每帧前发送4字节小端长度,PC端需加 --length-prefixed */
 /* 接收数据缓冲区 */
 char g_lwip_demo_recvbuf[LWIP_DEMO_RX_BUFSIZE]; 
 
@@ -123,6 +124,10 @@ void lwip_send_thread(void *pvParameters)
         if (g_lwip_connect_state == 1) /* 有数据要发送 */
         {
             camera_frame = esp_camera_fb_get();
+#if LWIP_DEMO_LENGTH_PREFIX
+            uint32_t frame_len = camera_frame->len;             /* ESP32为小端,与PC端解析一致 */
+            send(g_sock, &frame_len, sizeof(frame_len), 0);
+#endif
             send(g_sock, camera_frame->buf, camera_frame->len,0);
             esp_camera_fb_return(camera_frame);
         }
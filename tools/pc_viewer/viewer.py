@@ -15,14 +15,25 @@ TCP 服务器端 Python 显示程序
 import argparse
 import socket
 import sys
+import threading
 import time
-from typing import Tuple
+from typing import Callable, List, Optional, Tuple
 
 import cv2
 import numpy as np
 
+try:
+    from turbojpeg import TurboJPEG  # 可选：libjpeg-turbo 解码后端（pip install PyTurboJPEG）
+except ImportError:
+    TurboJPEG = None
+
 SOI = b"\xff\xd8"  # JPEG Start Of Image
 EOI = b"\xff\xd9"  # JPEG End Of Image
+RING_SIZE = 4 * 1024 * 1024  # 接收缓冲区大小，需大于单帧 JPEG
+RECV_SIZE = 64 * 1024  # 单次 recv 上限
+MAX_FRAME_BYTES = 2 * 1024 * 1024  # 单帧 JPEG 上限，超过则认为数据流失步
+# Linux 收到数据后会退出 quick-ack 模式，需要在每次 recv 后重新开启，避免延迟 ACK 拖慢ESP32发送
+TCP_QUICKACK = getattr(socket, "TCP_QUICKACK", None)  # 仅 Linux
 
 
 def parse_args() -> argparse.Namespace:
@@ -31,75 +42,201 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--port", type=int, default=8000, help="监听端口，需与固件一致，默认 8000")
     parser.add_argument("--window", default="ESP32 Camera", help="显示窗口标题")
     parser.add_argument("--timeout", type=float, default=10.0, help="等待连接超时（秒）")
+    parser.add_argument("--scale", type=int, choices=(1, 2, 4, 8), default=1,
+                        help="解码缩小倍数（在 DCT 域缩放，倍数越大解码越快），默认 1")
     return parser.parse_args()
 
 
-def recv_images(conn: socket.socket, window: str) -> None:
-    buf = bytearray()
-    last_ts = time.time()
-    frames = 0
+def recv_images(conn: socket.socket, frame_q: "LatestFrame", stop: threading.Event) -> None:
+    """接收线程：只负责从套接字切分出完整 JPEG 帧并放入队列，不做解码与显示"""
+    # 固定大小接收缓冲区 + 读写指针：消费一帧只需前移 head，不再搬移尾部数据；
+    # 仅当写指针接近末尾时，才把剩余的半帧搬回开头
+    ring = bytearray(RING_SIZE)
+    view = memoryview(ring)
+    head = tail = 0
+    scan = 0  # 已扫描过的位置，新数据到达后从此处（回退 1 字节以覆盖跨 recv 的 0xFF）继续查找
 
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     conn.settimeout(5.0)
-    while True:
-        try:
-            data = conn.recv(4096)
-            if not data:
-                print("[INFO] 对端关闭连接")
+    try:
+        while not stop.is_set():
+            if tail + RECV_SIZE > RING_SIZE:
+                pending = tail - head
+                if pending + RECV_SIZE > RING_SIZE:
+                    # 单帧超出缓冲区，丢弃并重新同步
+                    head = tail = scan = 0
+                else:
+                    ring[:pending] = ring[head:tail]
+                    scan -= head
+                    head, tail = 0, pending
+            try:
+                # 直接写入缓冲区空闲部分，避免每次 recv 分配新的 bytes
+                n = conn.recv_into(view[tail:tail + RECV_SIZE])
+                if not n:
+                    print("[INFO] 对端关闭连接")
+                    break
+                if TCP_QUICKACK is not None:
+                    conn.setsockopt(socket.IPPROTO_TCP, TCP_QUICKACK, 1)
+            except socket.timeout:
+                # 超时不致命，继续等待
+                continue
+            except ConnectionResetError:
+                print("[WARN] 连接被重置")
                 break
-            buf.extend(data)
-        except socket.timeout:
-            # 超时不致命，继续等待
-            continue
-        except ConnectionResetError:
-            print("[WARN] 连接被重置")
-            break
+            except Exception as e:
+                if not stop.is_set():
+                    print(f"[ERROR] 接收失败: {e}")
+                break
+            tail += n
+
+            # 可能存在多个完整帧：全部切分消费，但只把最新的一帧交给显示线程，
+            # 解码跟不上时直接跳过过期帧
+            sois, eois = scan_markers(view, max(head, scan - 1), tail)
+            scan = tail
+            in_frame = ring.startswith(SOI, head, tail)
+            latest = None
+            si = ei = 0
+            while True:
+                if not in_frame:
+                    # 丢弃 SOI 之前的冗余
+                    while si < len(sois) and sois[si] < head:
+                        si += 1
+                    if si == len(sois):
+                        # 保留最后 1 字节，可能是跨 recv 的 0xFF
+                        head = max(head, tail - 1)
+                        break
+                    head = sois[si]
+                    in_frame = True
+                while ei < len(eois) and eois[ei] < head + 2:
+                    ei += 1
+                if ei == len(eois):
+                    break
+                end = eois[ei] + 2  # 包含 EOI
+                latest = (head, end)
+                head = end
+                in_frame = False
+            if in_frame and tail - head > MAX_FRAME_BYTES:
+                # 帧长超出上限视为失步：跳到最近的 SOI 重新同步，没有则整体丢弃
+                head = sois[-1] if sois and sois[-1] > head else tail - 1
+            if latest is not None:
+                # 经 memoryview 切片只拷贝一次（bytearray 切片会先多拷贝一份）；
+                # 帧要跨线程交给显示端，而缓冲区随后会被覆盖，因此这一次拷贝不能省
+                frame_q.put(bytes(view[latest[0]:latest[1]]))
+    finally:
+        # 通知显示线程结束
+        frame_q.put(None)
+
+
+def scan_markers(view: memoryview, lo: int, hi: int) -> Tuple[List[int], List[int]]:
+    """对 [lo, hi) 做一次向量化扫描，返回其中全部 SOI 与 EOI 的绝对位置（升序）"""
+    arr = np.frombuffer(view[lo:hi], dtype=np.uint8)
+    ff = np.flatnonzero(arr[:-1] == 0xFF)
+    nxt = arr[ff + 1]
+    return (ff[nxt == 0xD8] + lo).tolist(), (ff[nxt == 0xD9] + lo).tolist()
+
+
+class LatestFrame:
+    """单生产者/单消费者的最新帧信箱：新帧直接覆盖旧帧，实时视频优先保证新鲜度。
+
+    生产者只做一次元组引用赋值（CPython 中是原子的），收发两端都不需要加锁；
+    Event 只在消费者没有新帧可取、需要睡眠等待时使用。
+    """
+
+    def __init__(self) -> None:
+        self._item: Optional[Tuple[int, Optional[bytes]]] = None  # (序号, 帧)，帧为 None 表示接收结束
+        self._seq = 0  # 只由生产者写
+        self._event = threading.Event()
+
+    def put(self, frame: Optional[bytes]) -> None:
+        self._seq += 1
+        self._item = (self._seq, frame)
+        self._event.set()
+
+    def get(self, last_seq: int, timeout: float) -> Optional[Tuple[int, Optional[bytes]]]:
+        """返回比 last_seq 新的 (序号, 帧)；timeout 秒内没有新帧返回 None"""
+        item = self._item
+        if item is None or item[0] == last_seq:
+            self._event.clear()
+            # clear 之后再检查一次，避免丢失在两次读取之间到达的帧
+            item = self._item
+            if item is None or item[0] == last_seq:
+                if not self._event.wait(timeout):
+                    return None
+                item = self._item
+        return item
+
+
+# --scale 与 OpenCV 缩小解码标志的对应关系
+_IMREAD_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def make_decoder(scale: int) -> Callable[[np.ndarray], Optional[np.ndarray]]:
+    """返回 JPEG 解码函数：优先使用 libjpeg-turbo，不可用时回退到 cv2.imdecode"""
+    if TurboJPEG is not None:
+        try:
+            jpeg = TurboJPEG()
+            factor = (1, scale)
+
+            def _decode_turbo(np_frame: np.ndarray) -> Optional[np.ndarray]:
+                try:
+                    return jpeg.decode(np_frame, scaling_factor=factor)
+                except Exception:
+                    return None
+            print("[INFO] 使用 libjpeg-turbo 解码")
+            return _decode_turbo
         except Exception as e:
-            print(f"[ERROR] 接收失败: {e}")
-            break
-
-        # 丢弃 SOI 之前的冗余
-        start = buf.find(SOI)
-        if start > 0:
-            del buf[:start]
-        elif start < 0 and len(buf) > 1024 * 1024:
-            # 避免内存无限增长
-            buf.clear()
-            continue
+            print(f"[WARN] 加载 libjpeg-turbo 失败，回退 OpenCV：{e}")
 
-        # 可能存在多个完整帧，尽量逐个消费
-        while True:
-            start = buf.find(SOI)
-            if start < 0:
-                break
-            end = buf.find(EOI, start + 2)
-            if end < 0:
-                break
-            end += 2  # 包含 EOI
-            frame = bytes(buf[start:end])
-            del buf[:end]
-
-            # 解码并显示
-            np_frame = np.frombuffer(frame, dtype=np.uint8)
-            img = cv2.imdecode(np_frame, cv2.IMREAD_COLOR)
-            if img is None:
-                # 解码失败，继续
-                continue
-            cv2.imshow(window, img)
-            frames += 1
+    flag = _IMREAD_FLAGS[scale]
+    return lambda np_frame: cv2.imdecode(np_frame, flag)
 
-            # FPS 统计
-            now = time.time()
-            if now - last_ts >= 1.0:
-                fps = frames / (now - last_ts)
-                cv2.setWindowTitle(window, f"ESP32 Camera - {fps:.1f} FPS")
-                frames = 0
-                last_ts = now
 
+def show_images(frame_q: LatestFrame, window: str, scale: int = 1) -> None:
+    """显示循环：解码与 imshow/waitKey 在此进行，不会阻塞网络接收"""
+    decode = make_decoder(scale)
+    last_ts = time.time()
+    frames = 0
+    seq = 0
+
+    while True:
+        item = frame_q.get(seq, timeout=0.1)
+        if item is None:
+            # 无新帧时也要泵送 GUI 事件
             if cv2.waitKey(1) & 0xFF == ord('q'):
                 return
+            continue
+        seq, frame = item
+        if frame is None:
+            return
 
+        # 解码并显示
+        np_frame = np.frombuffer(frame, dtype=np.uint8)
+        img = decode(np_frame)
+        if img is None:
+            # 解码失败，继续
+            continue
+        cv2.imshow(window, img)
+        frames += 1
+
+        # FPS 统计
+        now = time.time()
+        if now - last_ts >= 1.0:
+            fps = frames / (now - last_ts)
+            cv2.setWindowTitle(window, f"ESP32 Camera - {fps:.1f} FPS")
+            frames = 0
+            last_ts = now
+
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            return
 
-def run_server(host: str, port: int, window: str, timeout: float) -> int:
+
+def run_server(host: str, port: int, window: str, timeout: float, scale: int = 1) -> int:
     def _get_default_iface_ip() -> str:
         try:
             tmp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -153,9 +290,20 @@ def run_server(host: str, port: int, window: str, timeout: float) -> int:
 
         print(f"[INFO] 已连接：{addr}")
         with conn:
+            # 接收在后台线程进行；OpenCV 窗口留在主线程（部分平台要求 GUI 在主线程）
+            frame_q = LatestFrame()
+            stop = threading.Event()
+            rx = threading.Thread(target=recv_images, args=(conn, frame_q, stop), daemon=True)
+            rx.start()
             try:
-                recv_images(conn, window)
+                show_images(frame_q, window, scale)
             finally:
+                stop.set()
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                rx.join(timeout=1.0)
                 cv2.destroyAllWindows()
     return 0
 
@@ -163,7 +311,7 @@ def run_server(host: str, port: int, window: str, timeout: float) -> int:
 def main() -> int:
     args = parse_args()
     try:
-        return run_server(args.host, args.port, args.window, args.timeout)
+        return run_server(args.host, args.port, args.window, args.timeout, args.scale)
     except KeyboardInterrupt:
         print("\n[INFO] 已中断")
         return 0
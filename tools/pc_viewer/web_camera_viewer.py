@@ -13,79 +13,358 @@ ESP32 WiFi摄像头Web显示程序
     在浏览器中打开 http://localhost:5000 或 http://your-ip:5000
 """
 
+import sys
+
+# 使用 gevent 服务器时，必须在导入 socket/threading 等模块之前打补丁，
+# 这样接收线程、Condition 等都会变成协作式的 greenlet 实现
+_GEVENT = "--server=gevent" in sys.argv or any(
+    a == "--server" and b == "gevent" for a, b in zip(sys.argv, sys.argv[1:]))
+if _GEVENT:
+    import gevent
+    from gevent import monkey
+    monkey.patch_all()
+
 import argparse
+import collections
+import functools
+import gzip
+import os
 import socket
-import sys
 import time
 import threading
-from typing import Optional
-from queue import Queue, Empty
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 import io
 
-from flask import Flask, render_template_string, Response, jsonify
+from flask import Flask, render_template_string, Response, jsonify, request
 import cv2
 import numpy as np
 
+try:
+    from turbojpeg import TurboJPEG  # 可选：libjpeg-turbo 编解码后端（pip install PyTurboJPEG）
+except ImportError:
+    TurboJPEG = None
+try:
+    import orjson  # 可选：更快的JSON序列化（pip install orjson）
+except ImportError:
+    orjson = None
+
 SOI = b"\xff\xd8"  # JPEG Start Of Image
 EOI = b"\xff\xd9"  # JPEG End Of Image
+RECV_BUF_SIZE = 4 * 1024 * 1024  # TCP接收缓冲区最小大小（至少为单帧上限 + 单次 recv）
+# Linux 收到数据后会退出 quick-ack 模式，需要在每次 recv 后重新开启，避免延迟 ACK 拖慢ESP32发送
+TCP_QUICKACK = getattr(socket, "TCP_QUICKACK", None)  # 仅 Linux
+
+# MJPEG 分段头/尾
+_MJPEG_PREFIX = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+_MJPEG_SUFFIX = b'\r\n'
+# 画框后重新编码的质量：70 比 80 小约 30% 且编码更快；视频流不启用哈夫曼表优化（编码耗时约 2.5 倍，仅省约 10%）
+STREAM_JPEG_QUALITY = 70
+
+# =============== JPEG 编解码 ===============
+def _load_turbojpeg():
+    if TurboJPEG is None:
+        return None
+    try:
+        return TurboJPEG()
+    except Exception as e:
+        print(f"[WARN] 加载 libjpeg-turbo 失败，回退 OpenCV：{e}")
+        return None
+
+_turbo = _load_turbojpeg()
+
+def _decode_jpeg(data: bytes) -> Optional[np.ndarray]:
+    """解码为BGR图：优先使用 libjpeg-turbo（SIMD），不可用时回退 cv2.imdecode。"""
+    if _turbo is not None:
+        try:
+            return _turbo.decode(data)
+        except Exception:
+            return None
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+def _encode_jpeg(img: np.ndarray, quality: int, optimize: bool = False) -> Optional[bytes]:
+    """将BGR图编码为JPEG，失败返回 None。optimize 为 True 时（仅 OpenCV 后端）生成优化的哈夫曼表。"""
+    if _turbo is not None:
+        try:
+            return _turbo.encode(img, quality=quality)
+        except Exception:
+            return None
+    ok, buf = cv2.imencode('.jpg', img, [int(cv2.IMWRITE_JPEG_QUALITY), quality,
+                                         int(cv2.IMWRITE_JPEG_OPTIMIZE), int(optimize)])
+    return buf.tobytes() if ok else None
+
+def _run_blocking(fn, *args):
+    """执行CPU密集的调用（JPEG编解码、人脸检测等）。
+
+    gevent 模式下所有"线程"都是同一事件循环上的 greenlet，直接调用会冻结所有连接；
+    此时交给 hub 的原生线程池执行，只挂起当前 greenlet。其他模式下直接调用。
+    """
+    if _GEVENT:
+        return gevent.get_hub().threadpool.apply(fn, args)
+    return fn(*args)
+
+# 最新帧单槽：接收线程覆盖写入并递增序号后 notify_all；
+# 每个浏览器连接各自记住已发送的序号，因此每个新帧对每个观看者都只推送一次
+frame_cond = threading.Condition()
+_slot_frame: Optional[bytes] = None
+_slot_seq = 0
 
-# 全局变量用于存储最新的图像帧
-latest_frame = None
-frame_lock = threading.Lock()
-frame_queue = Queue(maxsize=10)  # 限制队列大小避免内存溢出
+# 最近若干帧的JPEG（只保存引用，不拷贝），供 /snapshot_batch 批量导出
+SNAPSHOT_RING_SIZE = 16
+_recent_frames = collections.deque(maxlen=SNAPSHOT_RING_SIZE)
+# 批量解码线程池：libjpeg-turbo / cv2 解码时会释放GIL，多帧可真正并行
+_snapshot_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 4)
 
 # =============== 人脸检测 / 识别 ===============
 face_lock = threading.Lock()
-face_db = {}  # face_id -> {id, embedding, first_seen, last_seen, seen_count, thumb_jpeg}
+face_db = collections.OrderedDict()  # face_id -> {id, row, first_seen, last_seen, seen_count, thumb_jpeg}，最久未出现的在前
+_face_db_version = 0  # face_db 每次变化后递增，用作 /faces 的 ETag
+_FACE_DB_EPOCH = format(int(time.time()), 'x')  # 区分不同进程的版本号，避免重启后误判为未变化
+FACE_DB_CAPACITY = 256  # 人脸库上限，超出时淘汰最久未出现的人脸
+FACE_MERGE_INTERVAL = 1000  # 每隔多少帧合并一次重复人脸
 next_face_id = 1
+# 所有人脸特征按行存放在一个连续矩阵中（face_db[fid]['row'] 为行号），匹配时一次矩阵运算算出全部距离
+_EMB_DIM = 64 * 64
+_face_emb = np.empty((0, _EMB_DIM), dtype=np.float32)
+_face_sq = np.empty(0, dtype=np.float32)  # 各行特征的平方范数
+_face_row_ids = []  # 行号 -> face_id
+_face_rows = 0
 face_enabled = True
-face_cascade = None
+face_detector = None  # (frame_bgr, gray) -> [(x, y, w, h), ...]，坐标为原图尺寸
+face_dnn_dir: Optional[str] = None  # --face-dnn 指定的 ResNet10-SSD 模型目录
+face_yunet_path: Optional[str] = None  # --face-yunet 指定的 YuNet ONNX 模型文件
+_YUNET_WIDTH = 320  # YuNet 推理宽度：画面先等比缩小到该宽度再检测
+use_opencl = False  # --opencl 且设备可用时为 True
+_DNN_PROTOTXT = 'deploy.prototxt'
+_DNN_WEIGHTS = 'res10_300x300_ssd_iter_140000.caffemodel'
 _face_frame_counter = 0
+SCENE_CHANGE_BITS = 4  # 场景哈希相差超过该位数才视为画面变化
+FACE_REDETECT_SEC = 2.0  # 画面静止时的最长检测间隔
+_annotated_lock = threading.Lock()
+_annotated = (0, 0, b'')  # 最近一次画框结果：(帧序号, 检测结果序号, JPEG)
+_face_overlay = (0, [])  # 检测线程的最新结果：(结果序号, [(x, y, w, h, face_id), ...])
+
+_HAAR_SCALE = 0.6  # 整帧扫描的缩放比例
+_HAAR_MIN_SIZE = 50  # 整帧扫描的 minSize（缩小后的像素），对应原图约 83 像素
+# 局部复查的最小缩放比例：再小的话 minSize 会低于级联的 24 像素检测窗口，可检出的最小人脸就会变大
+_HAAR_MIN_SCALE = 24 * _HAAR_SCALE / _HAAR_MIN_SIZE
+
+def _make_haar_detector(cascade, full_scan_every: int = 10):
+    # 相邻两次检测之间人脸位置变化不大：有上次结果时只在其周围（各边外扩 20%）的小区域内复查，
+    # 每 full_scan_every 次、或局部复查丢失了人脸时才以 0.6 倍扫描整帧，以发现新出现的人脸
+    last_rects = []  # 上次结果，原图坐标
+    ticks = 0
+
+    def shrink(gray: np.ndarray, scale: float) -> np.ndarray:
+        h, w = gray.shape[:2]
+        # 非整数倍缩小时 INTER_AREA 比 INTER_LINEAR 慢 5 倍以上；级联检测内部的图像金字塔本身也是线性插值
+        return cv2.resize(gray, (max(1, int(w*scale)), max(1, int(h*scale))), interpolation=cv2.INTER_LINEAR)
+
+    def detect(frame_bgr: np.ndarray, gray: np.ndarray):
+        nonlocal last_rects, ticks
+        ticks += 1
+        rects = []  # 原图坐标
+        if last_rects and ticks % full_scan_every:
+            # 复查时的缩放比例随已跟踪的最小人脸自适应：人脸越大缩得越小（级联检测耗时约与像素数成正比），
+            # minSize 同比例缩小，原图上可检出的最小人脸保持不变
+            smallest = min(max(rw, rh) for (_, _, rw, rh) in last_rects)
+            scale = min(_HAAR_SCALE, max(_HAAR_MIN_SCALE, 60.0 / smallest))
+            min_side = max(24, int(_HAAR_MIN_SIZE * scale / _HAAR_SCALE))
+            small = shrink(gray, scale)
+            sh, sw = small.shape[:2]
+            for (x, y, ww, hh) in last_rects:
+                x, y, ww, hh = int(x*scale), int(y*scale), int(ww*scale), int(hh*scale)
+                px, py = int(0.2 * ww), int(0.2 * hh)
+                x0 = max(0, x - px); y0 = max(0, y - py)
+                x1 = min(sw, x + ww + px); y1 = min(sh, y + hh + py)
+                if x1 - x0 < min_side or y1 - y0 < min_side:
+                    continue
+                found = cascade.detectMultiScale(small[y0:y1, x0:x1], scaleFactor=1.05, minNeighbors=3,
+                                                 minSize=(min_side, min_side), maxSize=(x1 - x0, y1 - y0))
+                if len(found):
+                    fx, fy, fw, fh = max(found, key=lambda r: r[2] * r[3])
+                    rects.append((int((x0 + fx) / scale), int((y0 + fy) / scale), int(fw / scale), int(fh / scale)))
+        if len(rects) < len(last_rects) or not rects:
+            small = shrink(gray, _HAAR_SCALE)
+            side = min(small.shape[:2])
+            # 整帧扫描的检测窗口最多，值得交给 OpenCL（传入 UMat 即走 OpenCL 实现）；局部复查区域太小，留在CPU上
+            src = cv2.UMat(small) if use_opencl else small
+            rects = [(int(x/_HAAR_SCALE), int(y/_HAAR_SCALE), int(ww/_HAAR_SCALE), int(hh/_HAAR_SCALE)) for (x, y, ww, hh) in
+                     cascade.detectMultiScale(src, scaleFactor=1.15, minNeighbors=5,
+                                              minSize=(_HAAR_MIN_SIZE, _HAAR_MIN_SIZE), maxSize=(side, side))]
+        last_rects = rects
+        return rects
+    return detect
+
+def _make_dnn_detector(net, conf_threshold: float = 0.5):
+    # 检测只在 face_detector_loop 一个线程中执行，这把锁仅作防御：
+    # 若日后有其他线程调用，同一个网络对象不能被同时 forward
+    lock = threading.Lock()
+
+    def detect(frame_bgr: np.ndarray, gray: np.ndarray):
+        h, w = frame_bgr.shape[:2]
+        blob = cv2.dnn.blobFromImage(frame_bgr, 1.0, (300, 300), (104.0, 177.0, 123.0))
+        with lock:
+            net.setInput(blob)
+            out = net.forward()
+        # 输出形状 (1, 1, N, 7)，每行为 [_, _, 置信度, x0, y0, x1, y1]，坐标归一化到 0~1
+        dets = out[0, 0]
+        dets = dets[dets[:, 2] > conf_threshold]
+        boxes = np.clip(dets[:, 3:7], 0.0, 1.0) * np.array([w, h, w, h], dtype=np.float32)
+        return [(x0, y0, x1 - x0, y1 - y0)
+                for x0, y0, x1, y1 in boxes.astype(int).tolist() if x1 > x0 and y1 > y0]
+    return detect
+
+def _make_yunet_detector(detector):
+    input_size = None
+
+    def detect(frame_bgr: np.ndarray, gray: np.ndarray):
+        nonlocal input_size
+        h, w = frame_bgr.shape[:2]
+        scale = min(1.0, _YUNET_WIDTH / w)
+        img = frame_bgr
+        if scale < 1.0:
+            img = cv2.resize(frame_bgr, (max(1, int(w*scale)), max(1, int(h*scale))), interpolation=cv2.INTER_LINEAR)
+        size = (img.shape[1], img.shape[0])
+        if size != input_size:
+            detector.setInputSize(size)
+            input_size = size
+        # 输出形状 (N, 15)：前 4 列为 [x, y, w, h]，其后为 5 个关键点与置信度
+        _, faces = detector.detect(img)
+        if faces is None:
+            return []
+        boxes = faces[:, :4] / scale
+        return [(x, y, bw, bh) for x, y, bw, bh in boxes.astype(int).tolist() if bw > 0 and bh > 0]
+    return detect
+
+def _load_yunet_detector(model_path: str):
+    target = cv2.dnn.DNN_TARGET_OPENCL if use_opencl else cv2.dnn.DNN_TARGET_CPU
+    detector = cv2.FaceDetectorYN.create(model_path, "", (_YUNET_WIDTH, _YUNET_WIDTH), 0.6, 0.3, 5000,
+                                         cv2.dnn.DNN_BACKEND_OPENCV, target)
+    return _make_yunet_detector(detector)
+
+def _load_dnn_detector(model_dir: str):
+    net = cv2.dnn.readNetFromCaffe(os.path.join(model_dir, _DNN_PROTOTXT),
+                                   os.path.join(model_dir, _DNN_WEIGHTS))
+    net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+    net.setPreferableTarget(cv2.dnn.DNN_TARGET_OPENCL if use_opencl else cv2.dnn.DNN_TARGET_CPU)
+    return _make_dnn_detector(net)
 
 def _init_face_detector():
-    global face_cascade, face_enabled
+    global face_detector, face_enabled
+    if face_yunet_path:
+        try:
+            face_detector = _load_yunet_detector(face_yunet_path)
+            face_enabled = True
+            print('[INFO] 人脸检测已启用 (YuNet)')
+            return
+        except Exception as e:
+            print(f'[WARN] 加载YuNet人脸模型失败，回退其他检测器: {e}')
+    if face_dnn_dir:
+        try:
+            face_detector = _load_dnn_detector(face_dnn_dir)
+            face_enabled = True
+            print('[INFO] 人脸检测已启用 (DNN ResNet10-SSD)')
+            return
+        except Exception as e:
+            print(f'[WARN] 加载DNN人脸模型失败，回退 Haar Cascade: {e}')
     try:
-        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-        if face_cascade.empty():
+        cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        if cascade.empty():
             print('[WARN] 加载Haar人脸分类器失败，将禁用人脸功能')
             face_enabled = False
         else:
+            face_detector = _make_haar_detector(cascade)
             face_enabled = True
             print('[INFO] 人脸检测已启用 (Haar Cascade)')
     except Exception as e:
         print(f'[WARN] 初始化人脸检测失败: {e}')
         face_enabled = False
 
-def _compute_embedding(gray_roi: np.ndarray) -> Optional[np.ndarray]:
-    """简单的人脸特征向量：64x64灰度像素直方图均衡后展开并L2归一化。"""
-    try:
-        face_small = cv2.resize(gray_roi, (64, 64), interpolation=cv2.INTER_AREA)
-    except Exception:
-        return None
-    face_eq = cv2.equalizeHist(face_small)
-    vec = face_eq.astype(np.float32).reshape(-1)
-    vec -= vec.mean()
-    norm = np.linalg.norm(vec) + 1e-6
-    vec /= norm
-    return vec
+def _compute_embeddings(gray_rois) -> np.ndarray:
+    """批量计算人脸特征向量，返回 (N, _EMB_DIM)：64x64灰度直方图均衡后展开、减均值并逐行L2归一化。"""
+    vecs = np.empty((len(gray_rois), 64, 64), dtype=np.float32)
+    for i, roi in enumerate(gray_rois):
+        vecs[i] = cv2.equalizeHist(cv2.resize(roi, (64, 64), interpolation=cv2.INTER_AREA))
+    vecs = vecs.reshape(len(gray_rois), -1)
+    vecs -= vecs.mean(axis=1, keepdims=True)
+    vecs /= np.linalg.norm(vecs, axis=1, keepdims=True) + 1e-6
+    return vecs
 
 def _match_face(embedding: np.ndarray, threshold: float = 0.36) -> Optional[int]:
     """在face_db中查找最相近的人脸，欧氏距离小于阈值则视为同一人。"""
     with face_lock:
-        best_id = None
-        best_dist = 1e9
-        for fid, info in face_db.items():
-            emb = info.get('embedding')
-            if emb is None or emb.shape != embedding.shape:
-                continue
-            d = np.linalg.norm(emb - embedding)
-            if d < best_dist:
-                best_dist = d
-                best_id = fid
-        if best_dist <= threshold:
-            return best_id
+        n = _face_rows
+        if n == 0 or embedding.shape != (_EMB_DIM,):
+            return None
+        # ||e - x||² = ||e||² - 2·e·x + ||x||²：一次矩阵向量乘（BLAS）得到与所有人脸的距离
+        d2 = _face_sq[:n] - 2.0 * (_face_emb[:n] @ embedding)
+        best = int(np.argmin(d2))
+        if d2[best] + float(embedding @ embedding) <= threshold * threshold:
+            return _face_row_ids[best]
         return None
 
+def _append_face_row(fid: int, embedding: np.ndarray) -> int:
+    """在特征矩阵末尾追加一行（容量按倍数增长），返回行号。需持有 face_lock。"""
+    global _face_emb, _face_sq, _face_rows
+    if _face_rows == len(_face_emb):
+        cap = max(16, 2 * len(_face_emb))
+        emb = np.empty((cap, _EMB_DIM), dtype=np.float32)
+        emb[:_face_rows] = _face_emb[:_face_rows]
+        sq = np.empty(cap, dtype=np.float32)
+        sq[:_face_rows] = _face_sq[:_face_rows]
+        _face_emb, _face_sq = emb, sq
+    row = _face_rows
+    _face_emb[row] = embedding
+    _face_sq[row] = embedding @ embedding
+    _face_row_ids.append(fid)
+    _face_rows += 1
+    return row
+
+def _remove_face_row(row: int) -> None:
+    """删除特征矩阵中的一行（用最后一行填补空位）。需持有 face_lock。"""
+    global _face_rows
+    last = _face_rows - 1
+    if row != last:
+        _face_emb[row] = _face_emb[last]
+        _face_sq[row] = _face_sq[last]
+        moved = _face_row_ids[last]
+        _face_row_ids[row] = moved
+        face_db[moved]['row'] = row
+    _face_row_ids.pop()
+    _face_rows = last
+
+def _merge_duplicate_faces(threshold: float = 0.18) -> None:
+    """合并特征距离小于阈值（匹配阈值的一半）的重复人脸：保留较小的ID，累加出现次数，特征取平均。"""
+    global _face_db_version
+    with face_lock:
+        n = _face_rows
+        if n < 2:
+            return
+        emb = _face_emb[:n]
+        d2 = _face_sq[:n, None] + _face_sq[None, :n] - 2.0 * (emb @ emb.T)
+        rows_a, rows_b = np.nonzero(np.triu(d2 <= threshold * threshold, 1))
+        # 合并过程中行号会变化，先换算成ID
+        pairs = sorted((min(a, b), max(a, b)) for a, b in
+                       zip((_face_row_ids[r] for r in rows_a), (_face_row_ids[r] for r in rows_b)))
+        for keep, drop in pairs:
+            if keep not in face_db or drop not in face_db:
+                continue
+            k = face_db[keep]
+            d = face_db.pop(drop)
+            e = _face_emb[k['row']]
+            e += _face_emb[d['row']]
+            e *= 0.5
+            _face_sq[k['row']] = e @ e
+            k['first_seen'] = min(k['first_seen'], d['first_seen'])
+            if d['last_seen'] > k['last_seen']:
+                k['last_seen'] = d['last_seen']
+                face_db.move_to_end(keep)
+            k['seen_count'] += d['seen_count']
+            _remove_face_row(d['row'])
+            _face_db_version += 1
+
 def _make_thumbnail(bgr: np.ndarray, size: int = 112) -> Optional[bytes]:
     try:
         h, w = bgr.shape[:2]
@@ -94,24 +373,32 @@ def _make_thumbnail(bgr: np.ndarray, size: int = 112) -> Optional[bytes]:
         x0 = (w - side) // 2
         crop = bgr[y0:y0+side, x0:x0+side]
         thumb = cv2.resize(crop, (size, size), interpolation=cv2.INTER_AREA)
-        ok, buf = cv2.imencode('.jpg', thumb, [int(cv2.IMWRITE_JPEG_QUALITY), 85])
-        return buf.tobytes() if ok else None
+        # 缩略图很少重新编码却会被反复请求：用优化哈夫曼表换取更小的体积
+        return _encode_jpeg(thumb, 75, optimize=True)
     except Exception:
         return None
 
 def _update_face_db(face_img_bgr: np.ndarray, gray_roi: np.ndarray, embedding: np.ndarray) -> int:
     """匹配或新增人脸，返回face_id。"""
-    global next_face_id
+    global next_face_id, _face_db_version
     fid = _match_face(embedding)
     now = time.time()
-    thumb = _make_thumbnail(face_img_bgr)
+    # 缩略图只在新增人脸或每出现 20 次时才会保存，其余情况不必编码
+    info = face_db.get(fid) if fid is not None else None
+    thumb = None
+    if info is None or (info['seen_count'] + 1) % 20 == 0:
+        thumb = _make_thumbnail(face_img_bgr)
     with face_lock:
+        _face_db_version += 1
         if fid is None:
+            if len(face_db) >= FACE_DB_CAPACITY:
+                _, evicted = face_db.popitem(last=False)
+                _remove_face_row(evicted['row'])
             fid = next_face_id
             next_face_id += 1
             face_db[fid] = {
                 'id': fid,
-                'embedding': embedding.copy(),
+                'row': _append_face_row(fid, embedding),
                 'first_seen': now,
                 'last_seen': now,
                 'seen_count': 1,
@@ -120,389 +407,20 @@ def _update_face_db(face_img_bgr: np.ndarray, gray_roi: np.ndarray, embedding: n
         else:
             info = face_db.get(fid)
             if info is not None:
-                info['embedding'] = 0.8 * info['embedding'] + 0.2 * embedding
+                face_db.move_to_end(fid)
+                row = info['row']
+                # 0.8·e + 0.2·x 写成 0.8·(e - x) + x，原地更新矩阵行，不产生临时数组
+                emb = _face_emb[row]
+                emb -= embedding
+                emb *= 0.8
+                emb += embedding
+                _face_sq[row] = emb @ emb
                 info['last_seen'] = now
                 info['seen_count'] += 1
                 if info['seen_count'] % 20 == 0 and thumb is not None:
                     info['thumb_jpeg'] = thumb
     return fid
 
-# HTML模板
-HTML_TEMPLATE = '''
-<!DOCTYPE html>
-<html>
-<head>
-    <title>ESP32 WiFi Camera</title>
-    <style>
-        body {
-            font-family: Arial, sans-serif;
-            margin: 0;
-            padding: 20px;
-            background-color: #f0f0f0;
-            text-align: center;
-        }
-        .container {
-            max-width: 1200px;
-            margin: 0 auto;
-            background-color: white;
-            padding: 20px;
-            border-radius: 10px;
-            box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-        }
-        h1 {
-            color: #333;
-            margin-bottom: 30px;
-        }
-        .camera-container {
-            border: 3px solid #ddd;
-            border-radius: 10px;
-            display: inline-block;
-            padding: 10px;
-            background-color: #f9f9f9;
-        }
-        #camera-stream {
-            max-width: 100%;
-            height: auto;
-            border-radius: 5px;
-        }
-        .info {
-            margin-top: 20px;
-            color: #666;
-            font-size: 14px;
-        }
-        .status {
-            margin-top: 10px;
-            padding: 10px;
-            border-radius: 5px;
-        }
-        .status.connected {
-            background-color: #d4edda;
-            color: #155724;
-            border: 1px solid #c3e6cb;
-        }
-        .status.disconnected {
-            background-color: #f8d7da;
-            color: #721c24;
-            border: 1px solid #f5c6cb;
-        }
-        /* 全屏样式 */
-        .fullscreen-container {
-            position: fixed;
-            top: 0;
-            left: 0;
-            width: 100vw;
-            height: 100vh;
-            background-color: black;
-            z-index: 9999;
-            display: none;
-            justify-content: center;
-            align-items: center;
-        }
-        .fullscreen-container.show {
-            display: flex;
-        }
-        .fullscreen-container img {
-            width: 100vw;
-            height: 100vh;
-            object-fit: cover; /* 填满屏幕，可能会裁剪 */
-        }
-        .fullscreen-container img.contain {
-            width: auto;
-            height: auto;
-            max-width: 100vw;
-            max-height: 100vh;
-            object-fit: contain; /* 保持比例，完整显示 */
-        }
-        .fullscreen-container img.fill {
-            width: 100vw;
-            height: 100vh;
-            object-fit: fill; /* 拉伸填满，可能变形 */
-        }
-        .fullscreen-controls {
-            position: absolute;
-            top: 20px;
-            right: 20px;
-            z-index: 10000;
-            display: flex;
-            flex-direction: column;
-            gap: 10px;
-        }
-        .fullscreen-exit-btn {
-            background-color: rgba(255, 255, 255, 0.8);
-            border: none;
-            border-radius: 50%;
-            width: 50px;
-            height: 50px;
-            font-size: 20px;
-            cursor: pointer;
-            transition: background-color 0.3s;
-        }
-        .fullscreen-exit-btn:hover {
-            background-color: rgba(255, 255, 255, 1);
-        }
-        .fullscreen-mode-btn {
-            background-color: rgba(0, 123, 255, 0.8);
-            color: white;
-            border: none;
-            border-radius: 20px;
-            padding: 8px 12px;
-            font-size: 12px;
-            cursor: pointer;
-            transition: background-color 0.3s;
-            white-space: nowrap;
-        }
-        .fullscreen-mode-btn:hover {
-            background-color: rgba(0, 123, 255, 1);
-        }
-        .fullscreen-mode-btn.active {
-            background-color: rgba(40, 167, 69, 0.8);
-        }
-        /* 控制按钮 */
-        .controls {
-            margin-top: 20px;
-        }
-        .control-btn {
-            background-color: #007bff;
-            color: white;
-            border: none;
-            padding: 10px 20px;
-            margin: 0 5px;
-            border-radius: 5px;
-            cursor: pointer;
-            font-size: 14px;
-            transition: background-color 0.3s;
-        }
-        .control-btn:hover {
-            background-color: #0056b3;
-        }
-        .control-btn.fullscreen {
-            background-color: #28a745;
-        }
-        .control-btn.fullscreen:hover {
-            background-color: #1e7e34;
-        }
-    </style>
-    <script>
-        // 检查图像加载状态
-        function checkImageStatus() {
-            const img = document.getElementById('camera-stream');
-            const status = document.getElementById('status');
-            
-            img.onload = function() {
-                status.className = 'status connected';
-                status.textContent = '摄像头连接正常 - 正在接收图像流';
-            };
-            
-            img.onerror = function() {
-                status.className = 'status disconnected';
-                status.textContent = '摄像头连接断开 - 等待重新连接...';
-            };
-        }
-        
-        // 全屏模式状态
-        let currentFullscreenMode = 'cover'; // 默认为填满模式
-        
-        // 全屏功能
-        function toggleFullscreen() {
-            const fullscreenContainer = document.getElementById('fullscreen-container');
-            const fullscreenImg = document.getElementById('fullscreen-stream');
-            const originalImg = document.getElementById('camera-stream');
-            
-            if (fullscreenContainer.classList.contains('show')) {
-                // 退出全屏
-                exitFullscreen();
-            } else {
-                // 进入全屏
-                enterFullscreen();
-            }
-        }
-        
-        function enterFullscreen() {
-            const fullscreenContainer = document.getElementById('fullscreen-container');
-            const fullscreenImg = document.getElementById('fullscreen-stream');
-            const originalImg = document.getElementById('camera-stream');
-            
-            // 复制视频流到全屏容器
-            fullscreenImg.src = originalImg.src;
-            fullscreenContainer.classList.add('show');
-            
-            // 设置初始显示模式
-            setFullscreenMode(currentFullscreenMode);
-            
-            // 隐藏页面滚动条
-            document.body.style.overflow = 'hidden';
-            
-            // 监听ESC键退出全屏
-            document.addEventListener('keydown', handleEscapeKey);
-        }
-        
-        function setFullscreenMode(mode) {
-            const fullscreenImg = document.getElementById('fullscreen-stream');
-            const buttons = document.querySelectorAll('.fullscreen-mode-btn');
-            
-            // 清除所有模式类
-            fullscreenImg.className = '';
-            buttons.forEach(btn => btn.classList.remove('active'));
-            
-            // 设置新模式
-            currentFullscreenMode = mode;
-            if (mode === 'contain') {
-                fullscreenImg.classList.add('contain');
-            } else if (mode === 'fill') {
-                fullscreenImg.classList.add('fill');
-            }
-            // cover模式是默认的，不需要额外类
-            
-            // 高亮当前模式按钮
-            const activeButton = document.querySelector(`[onclick="setFullscreenMode('${mode}')"]`);
-            if (activeButton) {
-                activeButton.classList.add('active');
-            }
-        }
-            fullscreenContainer.classList.add('show');
-            
-            // 隐藏页面滚动条
-            document.body.style.overflow = 'hidden';
-            
-            // 监听ESC键退出全屏
-            document.addEventListener('keydown', handleEscapeKey);
-        }
-        
-        function exitFullscreen() {
-            const fullscreenContainer = document.getElementById('fullscreen-container');
-            
-            fullscreenContainer.classList.remove('show');
-            document.body.style.overflow = 'auto';
-            
-            // 移除ESC键监听
-            document.removeEventListener('keydown', handleEscapeKey);
-        }
-        
-        function handleEscapeKey(event) {
-            if (event.key === 'Escape') {
-                exitFullscreen();
-            }
-        }
-        
-        // 刷新视频流
-        function refreshStream() {
-            const img = document.getElementById('camera-stream');
-            const fullscreenImg = document.getElementById('fullscreen-stream');
-            const timestamp = new Date().getTime();
-            
-            // 刷新主图像
-            img.src = img.src.split('?')[0] + '?t=' + timestamp;
-            
-            // 如果在全屏模式，也刷新全屏图像
-            if (document.getElementById('fullscreen-container').classList.contains('show')) {
-                fullscreenImg.src = fullscreenImg.src.split('?')[0] + '?t=' + timestamp;
-            }
-        }
-        
-        // 页面加载后开始检查
-        window.onload = function() {
-            checkImageStatus();
-            // 定期刷新页面状态
-            setInterval(checkImageStatus, 5000);
-            
-            // 为图像添加双击全屏事件
-            const img = document.getElementById('camera-stream');
-            img.addEventListener('dblclick', toggleFullscreen);
-        };
-        // 人脸列表刷新函数
-        async function refreshFaces() {
-            try {
-                const res = await fetch('/faces?t=' + Date.now());
-                if (!res.ok) return;
-                const data = await res.json();
-                const list = document.getElementById('faces-grid');
-                const totalEl = document.getElementById('face-total');
-                if (!list) return;
-                list.innerHTML = '';
-                if (totalEl) totalEl.textContent = data.faces.length;
-                for (const f of data.faces) {
-                    const item = document.createElement('div');
-                    item.className = 'face-item';
-                    const img = document.createElement('img');
-                    img.className = 'face-thumb';
-                    img.alt = 'face ' + f.id;
-                    img.src = `/face_thumbnail/${f.id}.jpg?ts=${Math.floor(f.last_seen*1000)}`;
-                    const meta = document.createElement('div');
-                    meta.className = 'face-meta';
-                    const idSpan = document.createElement('span');
-                    idSpan.className = 'face-id';
-                    idSpan.textContent = `#${f.id}`;
-                    const statSpan = document.createElement('span');
-                    statSpan.className = 'face-stat';
-                    statSpan.title = `首次: ${new Date(f.first_seen*1000).toLocaleString()}\n最近: ${new Date(f.last_seen*1000).toLocaleString()}`;
-                    statSpan.textContent = `出现 ${f.seen_count}`;
-                    meta.appendChild(idSpan);
-                    meta.appendChild(statSpan);
-                    item.appendChild(img);
-                    item.appendChild(meta);
-                    list.appendChild(item);
-                }
-            } catch (e) {
-                // 忽略错误
-            }
-        }
-        // 页面加载后启动定时刷新
-        window.addEventListener('load', () => { try { refreshFaces(); } catch(e){} setInterval(refreshFaces, 2000); });
-    </script>
-</head>
-<body>
-    <div class="container">
-        <h1>ESP32 WiFi 摄像头实时显示</h1>
-        <div class="camera-container">
-            <img id="camera-stream" src="{{ url_for('video_feed') }}" alt="Camera Stream" title="双击进入全屏">
-        </div>
-        <div id="status" class="status disconnected">等待摄像头连接...</div>
-        
-        <!-- 控制按钮 -->
-        <div class="controls">
-            <button class="control-btn fullscreen" onclick="toggleFullscreen()">🔍 全屏显示</button>
-            <button class="control-btn" onclick="refreshStream()">🔄 刷新画面</button>
-        </div>
-        
-        <div class="info">
-            <p><strong>说明：</strong></p>
-            <p>• 双击图像或点击"全屏显示"按钮进入全屏模式</p>
-            <p>• 在全屏模式下可以切换不同的显示模式：</p>
-            <p>&nbsp;&nbsp;- 填满屏幕：图像填满整个屏幕（可能裁剪）</p>
-            <p>&nbsp;&nbsp;- 完整显示：保持比例完整显示（可能有黑边）</p>
-            <p>&nbsp;&nbsp;- 拉伸填满：强制填满屏幕（可能变形）</p>
-            <p>• 按ESC键或点击×按钮退出全屏</p>
-            <p>• 确保ESP32摄像头已连接到同一网络</p>
-            <p>• ESP32需要配置正确的服务器IP和端口</p>
-            <p>• 如果画面卡顿，请点击"刷新画面"按钮</p>
-        </div>
-
-        <!-- 人脸列表卡片 -->
-        <div class="card faces-card">
-            <header>
-                <div style="font-weight:600">已识别人脸</div>
-                <div class="hint">共 <span id="face-total">0</span> 个</div>
-            </header>
-            <div id="faces-grid" class="faces-grid"></div>
-            <div class="hint" style="margin-top:8px">识别采用轻量特征，正面、充足光照效果更佳</div>
-        </div>
-
-    </div>
-
-    <!-- 全屏容器 -->
-    <div id="fullscreen-container" class="fullscreen-container">
-        <div class="fullscreen-controls">
-            <button class="fullscreen-exit-btn" onclick="exitFullscreen()" title="退出全屏">×</button>
-            <button class="fullscreen-mode-btn active" onclick="setFullscreenMode('cover')" title="填满屏幕">🖼️ 填满</button>
-            <button class="fullscreen-mode-btn" onclick="setFullscreenMode('contain')" title="完整显示">📐 完整</button>
-            <button class="fullscreen-mode-btn" onclick="setFullscreenMode('fill')" title="拉伸填满">📏 拉伸</button>
-        </div>
-        <img id="fullscreen-stream" src="" alt="Fullscreen Camera Stream">
-    </div>
-</body>
-</html>
-'''
-
 # 新版极简美观前端模板
 HTML_TEMPLATE_NEW = '''
 <!DOCTYPE html>
@@ -718,226 +636,522 @@ HTML_TEMPLATE_NEW = '''
 '''
 
 def parse_args() -> argparse.Namespace:
-    parser = argparse.ArgumentParser(description="ESP32 WiFi Camera Web Viewer")
+    # 禁止选项缩写：是否打 gevent 补丁在导入阶段按完整的 --server 判断，
+    # 若允许 --serv gevent 之类的缩写，会在未打补丁的情况下启动 gevent 服务器
+    parser = argparse.ArgumentParser(description="ESP32 WiFi Camera Web Viewer", allow_abbrev=False)
     parser.add_argument("--host", default="0.0.0.0", help="TCP监听地址，默认 0.0.0.0")
     parser.add_argument("--port", type=int, default=8000, help="TCP监听端口，需与ESP32固件一致，默认 8000")
     parser.add_argument("--web-port", type=int, default=5000, help="Web服务端口，默认 5000")
     parser.add_argument("--timeout", type=float, default=10.0, help="等待连接超时（秒）")
+    parser.add_argument("--rcvbuf", type=int, default=1 << 20,
+                        help="TCP接收缓冲区大小（字节），默认 1 MiB；Linux 实际上限受 net.core.rmem_max 限制")
+    parser.add_argument("--recv-chunk", type=int, default=64 * 1024,
+                        help="单次 recv 读取的最大字节数，默认 64 KiB")
+    parser.add_argument("--max-frame-bytes", type=int, default=2 * 1024 * 1024,
+                        help="单帧JPEG上限（字节），超过仍未结束则丢弃并重新同步，默认 2 MiB")
+    parser.add_argument("--face-dnn", metavar="DIR",
+                        help=f"使用 OpenCV DNN (ResNet10-SSD) 人脸检测，DIR 中需包含 {_DNN_PROTOTXT} 与 {_DNN_WEIGHTS}；"
+                             "未指定或加载失败时使用 Haar Cascade")
+    parser.add_argument("--face-yunet", metavar="ONNX",
+                        help="使用 YuNet ONNX 模型（如 face_detection_yunet_2023mar_int8.onnx）做人脸检测，"
+                             "优先于 --face-dnn；加载失败时回退")
+    parser.add_argument("--length-prefixed", action="store_true",
+                        help="每帧前带 4 字节小端长度（需固件开启 LWIP_DEMO_LENGTH_PREFIX），按长度直接接收，不再查找帧边界")
+    parser.add_argument("--server", choices=("flask", "gevent", "waitress"), default="flask",
+                        help="Web服务器：flask 为每个浏览器连接一个线程；gevent 在单线程事件循环中服务所有连接，"
+                             "JPEG编解码与人脸检测交给原生线程池（需 pip install gevent）；waitress 为生产级线程池服务器（需 pip install waitress），默认 flask")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="waitress 工作线程数，每个浏览器视频流占用一个线程，默认8")
+    parser.add_argument("--opencl", action="store_true",
+                        help="OpenCL 设备可用时，用其执行整帧 Haar 检测或 DNN 推理；不可用时自动回退CPU")
     return parser.parse_args()
 
 
+@functools.lru_cache(maxsize=1)
 def get_default_ip() -> str:
-    """获取本机默认网卡IP地址"""
+    """获取本机默认网卡IP地址（结果缓存，只探测一次）"""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as tmp:
+            # 不会真正发包，仅用于获知默认路由的本地 IP
+            tmp.connect(("8.8.8.8", 80))
+            return tmp.getsockname()[0]
+    except Exception:
+        pass
     try:
-        tmp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        tmp.connect(("8.8.8.8", 80))
-        ip = tmp.getsockname()[0]
-        tmp.close()
-        return ip
+        # 无默认路由的隔离主机：退回主机名解析
+        return socket.gethostbyname(socket.gethostname())
     except Exception:
         return "127.0.0.1"
 
 
-def recv_images_thread(host: str, port: int, timeout: float) -> None:
+def _configure_conn(conn: socket.socket, rcvbuf: int) -> None:
+    """设置已接受连接的套接字选项：大接收缓冲、关闭 Nagle、开启 TCP 保活。"""
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # WiFi 掉线时由内核探测死连接：空闲 10 秒后每 3 秒探测一次，3 次失败即断开
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):  # Linux
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 10)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 3)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+    conn.settimeout(5.0)
+    actual = conn.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    if actual < rcvbuf:
+        print(f"[WARN] 接收缓冲区实际为 {actual} 字节（请求 {rcvbuf}），受系统上限约束")
+
+
+def recv_images_thread(host: str, port: int, timeout: float, rcvbuf: int = 1 << 20,
+                       recv_chunk: int = 64 * 1024, max_frame_bytes: int = 2 * 1024 * 1024,
+                       length_prefixed: bool = False) -> None:
     """TCP图像接收线程"""
-    global latest_frame
-    
     while True:
         print(f"[INFO] 尝试在 {host}:{port} 监听TCP连接...")
         
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
                 s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                
-                try:
-                    s.bind((host, port))
-                except PermissionError as e:
-                    print(f"[WARN] 绑定失败，尝试使用本机IP...")
-                    alt_host = get_default_ip() if host == "0.0.0.0" else host
-                    s.bind((alt_host, port))
-                    host = alt_host
-                
+                if hasattr(socket, "SO_REUSEPORT"):  # Windows 无此选项
+                    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                # 在 listen 之前设置，使 TCP 握手时即可通告更大的接收窗口
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+                s.bind((host, port))
                 s.listen(1)
                 s.settimeout(timeout)
                 print(f"[INFO] TCP服务器监听 {host}:{port}，等待ESP32连接...")
                 
-                try:
-                    conn, addr = s.accept()
+                # 监听套接字常驻，超时或连接断开后只需重新 accept
+                while True:
+                    try:
+                        conn, addr = s.accept()
+                    except socket.timeout:
+                        print("[WARN] 等待连接超时，继续监听...")
+                        continue
                     print(f"[INFO] ESP32已连接：{addr}")
+                    _configure_conn(conn, rcvbuf)
                     
                     with conn:
-                        recv_images_from_connection(conn)
-                        
-                except socket.timeout:
-                    print("[WARN] 等待连接超时，继续监听...")
-                    continue
+                        if length_prefixed:
+                            recv_length_prefixed_images(conn, max_frame_bytes)
+                        else:
+                            recv_images_from_connection(conn, recv_chunk, max_frame_bytes)
                     
+        except OSError as e:
+            # 绑定失败（如端口被占用 EADDRINUSE）等套接字错误：稍后重试
+            print(f"[ERROR] TCP服务器错误 (errno={e.errno}): {e}")
+            time.sleep(2)
         except Exception as e:
             print(f"[ERROR] TCP服务器错误: {e}")
             time.sleep(2)
+
+
+def _recv_exact(conn: socket.socket, view: memoryview) -> bool:
+    """把 view 收满；连接断开或出错返回 False。"""
+    got = 0
+    while got < len(view):
+        try:
+            n = conn.recv_into(view[got:])
+            if n and TCP_QUICKACK is not None:
+                conn.setsockopt(socket.IPPROTO_TCP, TCP_QUICKACK, 1)
+        except socket.timeout:
             continue
+        except Exception as e:
+            print(f"[ERROR] 接收数据失败: {e}")
+            return False
+        if not n:
+            print("[INFO] ESP32断开连接")
+            return False
+        got += n
+    return True
+
+
+def recv_length_prefixed_images(conn: socket.socket, max_frame_bytes: int = 2 * 1024 * 1024) -> None:
+    """接收带 4 字节小端长度前缀的图像帧：每帧只需读头、读体，无需逐字节查找 SOI/EOI"""
+    hdr = bytearray(4)
+    hdr_view = memoryview(hdr)
+    buf = bytearray(max_frame_bytes)
+    view = memoryview(buf)
+    while _recv_exact(conn, hdr_view):
+        size = int.from_bytes(hdr, 'little')
+        if not 0 < size <= max_frame_bytes:
+            # 长度字段无法重新同步，只能断开等待固件重连
+            print(f"[ERROR] 帧长度非法: {size}，断开连接")
+            break
+        if not _recv_exact(conn, view[:size]):
+            break
+        publish_frame(bytes(view[:size]))
+
+
+# _walk_jpeg_headers 的返回状态
+_WALK_MORE = 0   # 数据不足，等待更多数据
+_WALK_SCAN = 1   # 已越过 SOS 段头，进入熵编码数据
+_WALK_EOI = 2    # 在段头区域直接遇到 EOI
+_WALK_BAD = -1   # 不是合法的段结构，需重新同步
 
 
-def recv_images_from_connection(conn: socket.socket) -> None:
+def _walk_jpeg_headers(buf: bytearray, pos: int, tail: int) -> Tuple[int, int]:
+    """从 SOI 之后按段长度逐段跳过头部（APPn/DQT/DHT/SOFn 等）。
+
+    EXIF 缩略图本身也是完整的 JPEG，其中的 FFD8/FFD9 位于 APP1 段内部，
+    按长度整段跳过即可避免被误判为帧边界。返回 (新位置, 状态)。
+    """
+    while pos + 1 < tail:
+        if buf[pos] != 0xFF:
+            return pos, _WALK_BAD
+        marker = buf[pos + 1]
+        if marker == 0xFF:
+            # 填充字节
+            pos += 1
+            continue
+        if marker == 0xD9:
+            return pos + 2, _WALK_EOI
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # 无长度字段的独立标记（TEM / RSTn）
+            pos += 2
+            continue
+        if pos + 4 > tail:
+            return pos, _WALK_MORE
+        seg_len = (buf[pos + 2] << 8) | buf[pos + 3]
+        if seg_len < 2:
+            return pos, _WALK_BAD
+        pos += 2 + seg_len
+        if marker == 0xDA:
+            # SOS 之后是熵编码数据，其中的 0xFF 都经过填充（FF00）或为 RSTn，
+            # 第一个 FFD9 即为本帧的 EOI
+            return pos, _WALK_SCAN
+    return pos, _WALK_MORE
+
+
+def recv_images_from_connection(conn: socket.socket, recv_chunk: int = 64 * 1024,
+                                max_frame_bytes: int = 2 * 1024 * 1024) -> None:
     """从TCP连接接收图像数据"""
-    global latest_frame
-    
-    buf = bytearray()
-    conn.settimeout(5.0)
+    # 固定大小缓冲区 + 读写指针：recv_into 直接写入空闲区，取出一帧只需前移 head；
+    # 仅当尾部空间不足时才把剩余的半帧一次性搬回开头
+    recv_chunk = max(1, min(recv_chunk, RECV_BUF_SIZE // 2))
+    buf_size = max(RECV_BUF_SIZE, max_frame_bytes + recv_chunk)
+    buf = bytearray(buf_size)
+    view = memoryview(buf)
+    head = tail = 0
+    scan = 0  # 已扫描过的位置（绝对下标）
+    pos: Optional[int] = None  # 当前帧段头解析到的位置；None 表示尚未找到 SOI
+    in_scan = False  # 是否已进入熵编码数据
     
     while True:
+        if tail + recv_chunk > buf_size:
+            pending = tail - head
+            if pending + recv_chunk > buf_size:
+                # 单帧超出缓冲区，丢弃并重新同步
+                head = tail = scan = 0
+                pos = None
+            else:
+                buf[:pending] = buf[head:tail]
+                scan -= head
+                if pos is not None:
+                    pos -= head
+                head, tail = 0, pending
         try:
-            data = conn.recv(4096)
-            if not data:
+            n = conn.recv_into(view[tail:tail + recv_chunk])
+            if not n:
                 print("[INFO] ESP32断开连接")
                 break
-            buf.extend(data)
+            if TCP_QUICKACK is not None:
+                conn.setsockopt(socket.IPPROTO_TCP, TCP_QUICKACK, 1)
         except socket.timeout:
             continue
         except Exception as e:
             print(f"[ERROR] 接收数据失败: {e}")
             break
+        tail += n
 
-        # 查找JPEG帧边界
-        start = buf.find(SOI)
-        if start > 0:
-            del buf[:start]
-        elif start < 0 and len(buf) > 1024 * 1024:
-            buf.clear()
-            continue
-
-        # 提取完整的JPEG帧
+        # 查找JPEG帧边界：新数据到达后只从 scan 处（回退 1 字节以覆盖跨 recv 的 0xFF）
+        # 继续查找，避免重复扫描整个缓冲区。
+        # 一次 recv 可能带来多个完整帧（如 Wi-Fi 重传后的突发），只有最新一帧有意义：
+        # 先记下其位置，循环结束后只拷贝、发布一次
+        newest = None
         while True:
-            start = buf.find(SOI)
-            if start < 0:
-                break
-            end = buf.find(EOI, start + 2)
+            if pos is None:
+                start = buf.find(SOI, max(head, scan - 1), tail)
+                if start < 0:
+                    # SOI 之前的数据不可能属于任何帧，立即丢弃；
+                    # 保留最后 1 字节，它可能是跨 recv 的 0xFF
+                    head = scan = max(head, tail - 1)
+                    break
+                head = start
+                pos = scan = start + 2
+                in_scan = False
+
+            if not in_scan:
+                pos, state = _walk_jpeg_headers(buf, pos, tail)
+                if state == _WALK_BAD:
+                    # 段结构损坏：跳过这个 SOI 重新寻找
+                    head = scan = head + 2
+                    pos = None
+                    continue
+                if state == _WALK_EOI:
+                    end = pos
+                elif state == _WALK_SCAN:
+                    in_scan = True
+                    scan = pos
+                else:
+                    end = -1
+            if in_scan:
+                end = buf.find(EOI, max(pos, scan - 1), tail)
+                if end >= 0:
+                    end += 2
             if end < 0:
+                scan = max(scan, tail)
+                if tail - head > max_frame_bytes:
+                    # 超过单帧上限仍未见 EOI，视为数据流失步：丢弃后重新寻找 SOI
+                    print(f"[WARN] 帧长超过 {max_frame_bytes} 字节仍未结束，丢弃 {tail - 1 - head} 字节")
+                    head = scan = tail - 1
+                    pos = None
                 break
-            end += 2
-            
-            frame_data = bytes(buf[start:end])
-            del buf[:end]
-            
-            # 将帧数据放入队列
-            try:
-                frame_queue.put_nowait(frame_data)
-            except:
-                # 队列满时丢弃旧帧
-                try:
-                    frame_queue.get_nowait()
-                    frame_queue.put_nowait(frame_data)
-                except Empty:
-                    pass
-
-
-def _annotate_and_track(frame_bgr: np.ndarray) -> np.ndarray:
-    """对图像做人脸检测、识别与标注，返回标注后的BGR图。"""
-    global _face_frame_counter
-    h, w = frame_bgr.shape[:2]
 
-    if not face_enabled or face_cascade is None:
-        return frame_bgr
+            newest = (head, end)
+            head = scan = end
+            pos = None
+
+        if newest is not None:
+            # 提取完整的JPEG帧（只在此处拷贝一次；缓冲区仅在下一次 recv 前才会搬移）
+            publish_frame(bytes(view[newest[0]:newest[1]]))
+
+
+def publish_frame(frame_data: bytes) -> None:
+    """写入最新帧并唤醒所有等待中的MJPEG连接（旧帧直接被覆盖）。"""
+    global _slot_frame, _slot_seq
+    with frame_cond:
+        _slot_frame = frame_data
+        _slot_seq += 1
+        _recent_frames.append(frame_data)
+        frame_cond.notify_all()
+
+
+def wait_frame(last_seq: int, timeout: float) -> Tuple[Optional[bytes], int]:
+    """等待比 last_seq 更新的帧；超时返回 (None, last_seq)。"""
+    with frame_cond:
+        if not frame_cond.wait_for(lambda: _slot_seq != last_seq, timeout):
+            return None, last_seq
+        return _slot_frame, _slot_seq
 
-    # 降频检测以降低CPU占用
+
+def _face_detect_due() -> bool:
+    """本帧是否需要做人脸检测：降频为每 3 帧一次以降低CPU占用。"""
+    global _face_frame_counter
+    if not face_enabled or face_detector is None:
+        return False
     _face_frame_counter = (_face_frame_counter + 1) % 3
-    do_detect = (_face_frame_counter == 0)
+    return _face_frame_counter == 0
+
+def _detect_and_track(frame_bgr: np.ndarray, gray: np.ndarray) -> List[Tuple[int, int, int, int, int]]:
+    """对图像做人脸检测与识别并更新人脸库，返回 [(x, y, w, h, face_id), ...]。"""
+    h, w = frame_bgr.shape[:2]
 
+    if not face_enabled or face_detector is None:
+        return []
+
+    faces_rects = []
     try:
-        gray = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2GRAY)
+        for (X, Y, W, H) in face_detector(frame_bgr, gray):
+            pad = int(0.1 * max(W, H))
+            X0 = max(0, X - pad); Y0 = max(0, Y - pad)
+            X1 = min(w, X + W + pad); Y1 = min(h, Y + H + pad)
+            faces_rects.append((X0, Y0, X1 - X0, Y1 - Y0))
     except Exception:
-        return frame_bgr
+        faces_rects = []
 
-    faces_rects = []
-    if do_detect:
-        try:
-            scale = 0.6
-            small = cv2.resize(gray, (max(1, int(w*scale)), max(1, int(h*scale))), interpolation=cv2.INTER_AREA)
-            rects = face_cascade.detectMultiScale(small, scaleFactor=1.15, minNeighbors=5, minSize=(50, 50))
-            for (x, y, ww, hh) in rects:
-                X = int(x/scale); Y = int(y/scale); W = int(ww/scale); H = int(hh/scale)
-                pad = int(0.1 * max(W, H))
-                X0 = max(0, X - pad); Y0 = max(0, Y - pad)
-                X1 = min(w, X + W + pad); Y1 = min(h, Y + H + pad)
-                faces_rects.append((X0, Y0, X1 - X0, Y1 - Y0))
-        except Exception:
-            faces_rects = []
+    faces_rects = [r for r in faces_rects if r[2] > 0 and r[3] > 0]
+    if not faces_rects:
+        return []
+    try:
+        # 本帧所有人脸的特征一次批量算出；入库仍逐个进行，同一帧内新建的人脸也能参与后续匹配
+        embeddings = _compute_embeddings([gray[y:y+hh, x:x+ww] for (x, y, ww, hh) in faces_rects])
+    except Exception:
+        return []
 
-    for (x, y, ww, hh) in faces_rects:
+    tracked = []
+    for (x, y, ww, hh), emb in zip(faces_rects, embeddings):
         try:
             roi_gray = gray[y:y+hh, x:x+ww]
             roi_bgr = frame_bgr[y:y+hh, x:x+ww]
-            emb = _compute_embedding(roi_gray)
-            if emb is None:
-                continue
-            fid = _update_face_db(roi_bgr, roi_gray, emb)
-            cv2.rectangle(frame_bgr, (x, y), (x+ww, y+hh), (0, 200, 255), 2)
-            cv2.putText(frame_bgr, f"ID {fid}", (x, max(0, y-8)), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 200, 255), 2, cv2.LINE_AA)
+            tracked.append((x, y, ww, hh, _update_face_db(roi_bgr, roi_gray, emb)))
         except Exception:
             continue
 
+    return tracked
+
+def _draw_faces(frame_bgr: np.ndarray, faces) -> np.ndarray:
+    """在图像上画出人脸框与ID标签。"""
+    for (x, y, ww, hh, fid) in faces:
+        cv2.rectangle(frame_bgr, (x, y), (x+ww, y+hh), (0, 200, 255), 2)
+        cv2.putText(frame_bgr, f"ID {fid}", (x, max(0, y-8)), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 200, 255), 2, cv2.LINE_AA)
     return frame_bgr
 
+def _scene_hash(gray: np.ndarray) -> int:
+    """64 位差值哈希（dHash）：缩小到 9x8 后比较相邻像素的明暗。"""
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    return int.from_bytes(np.packbits(small[:, 1:] > small[:, :-1]).tobytes(), 'big')
+
+def _prepare_detect_frame(frame_data: bytes):
+    """解码并转为灰度，返回 (BGR图, 灰度图, 场景哈希)；失败返回 None。"""
+    frame = _decode_jpeg(frame_data)
+    if frame is None:
+        return None
+    try:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    except Exception:
+        return None
+    return frame, gray, _scene_hash(gray)
+
+def face_detector_loop() -> None:
+    """人脸检测线程：从最新帧槽取帧，检测结果以 (序号, 人脸列表) 整体替换 _face_overlay。
+
+    检测只在这里执行一次，与连接的浏览器数量无关，也不会阻塞MJPEG输出。
+    """
+    global _face_overlay
+    seq = 0
+    frames = 0
+    last_hash = None
+    last_detect = 0.0
+    while True:
+        frame_data, seq = wait_frame(seq, 1.0)
+        if frame_data is None:
+            continue
+        frames += 1
+        if frames % FACE_MERGE_INTERVAL == 0:
+            _run_blocking(_merge_duplicate_faces)
+        if not _face_detect_due():
+            continue
+        prepared = _run_blocking(_prepare_detect_frame, frame_data)
+        if prepared is None:
+            continue
+        frame, gray, frame_hash = prepared
+        faces = _face_overlay[1]
+        now = time.monotonic()
+        # 画面几乎没变（哈希差异不超过阈值）时沿用上次结果，但至少每隔一段时间重新检测一次
+        if (last_hash is None or bin(frame_hash ^ last_hash).count('1') > SCENE_CHANGE_BITS
+                or now - last_detect >= FACE_REDETECT_SEC):
+            faces = _run_blocking(_detect_and_track, frame, gray)
+            last_hash = frame_hash
+            last_detect = now
+        # 单次引用赋值即可完成交接（GIL保证原子性），读者拿到的永远是一份完整结果
+        _face_overlay = (_face_overlay[0] + 1, faces)
+
+def _make_waiting_part() -> bytes:
+    """生成"等待连接"占位图的完整MJPEG分段（只在导入时执行一次）。"""
+    img = np.zeros((240, 320, 3), dtype=np.uint8)
+    cv2.putText(img, "Waiting for ESP32...", (50, 120),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
+    _, buffer = cv2.imencode('.jpg', img)
+    return _MJPEG_PREFIX + buffer.tobytes() + _MJPEG_SUFFIX
+
+_WAITING_PART = _make_waiting_part()
+
+def _render_annotated(frame_data: bytes, faces) -> bytes:
+    """解码、画框后重新编码；失败时原样返回。"""
+    frame = _decode_jpeg(frame_data)
+    if frame is None:
+        return frame_data
+    return _encode_jpeg(_draw_faces(frame, faces), STREAM_JPEG_QUALITY) or frame_data
+
+def _annotated_frame(seq: int, frame_data: bytes, overlay_seq: int, faces) -> bytes:
+    """返回画好人脸框的JPEG：同一帧、同一检测结果只解码和编码一次，供所有连接复用。"""
+    global _annotated
+    # 持锁编码：同时到达的其他连接等待并直接取用结果，而不是各自重复编码同一帧
+    with _annotated_lock:
+        cached_seq, cached_overlay, data = _annotated
+        if cached_seq == seq and cached_overlay == overlay_seq:
+            return data
+        data = _run_blocking(_render_annotated, frame_data, faces)
+        _annotated = (seq, overlay_seq, data)
+        return data
+
 def generate_frames():
     """生成MJPEG流帧"""
-    # 初始化人脸检测器
-    if face_enabled and (face_cascade is None):
-        _init_face_detector()
+    seq = 0
+    overlay_seq = _face_overlay[0]
     while True:
-        try:
-            # 从队列获取最新帧
-            frame_data = frame_queue.get(timeout=1.0)
-            # 解码、标注后再编码
-            npbuf = np.frombuffer(frame_data, dtype=np.uint8)
-            frame = cv2.imdecode(npbuf, cv2.IMREAD_COLOR)
-            if frame is None:
-                out_bytes = frame_data
-            else:
-                # 人脸检测与标注
-                try:
-                    out_img = _annotate_and_track(frame)
-                except NameError:
-                    # 尚未定义标注函数（安全兜底）
-                    out_img = frame
-                ok, enc = cv2.imencode('.jpg', out_img, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
-                out_bytes = enc.tobytes() if ok else frame_data
-            # 构造MJPEG边界
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + out_bytes + b'\r\n')
-                   
-        except Empty:
-            # 队列为空时发送空白帧
-            # 创建一个简单的"等待连接"图像
-            img = np.zeros((240, 320, 3), dtype=np.uint8)
-            cv2.putText(img, "Waiting for ESP32...", (50, 120), 
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
-            
-            _, buffer = cv2.imencode('.jpg', img)
-            frame_data = buffer.tobytes()
-            
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_data + b'\r\n')
+        # 等待最新帧，1 秒内没有新帧则发送预先生成的"等待连接"帧
+        frame_data, seq = wait_frame(seq, 1.0)
+        if frame_data is None:
+            yield _WAITING_PART
+            continue
+
+        overlay_seq_now, faces = _face_overlay
+        if overlay_seq_now == overlay_seq or not faces:
+            # 没有新的检测结果（或画面中无人脸）时画面不会被修改：原样转发ESP32的JPEG，省去解码与重新编码
+            overlay_seq = overlay_seq_now
+            yield _MJPEG_PREFIX
+            yield frame_data
+            yield _MJPEG_SUFFIX
+            continue
+        overlay_seq = overlay_seq_now
+
+        # 检测线程给出新结果时：换成画好人脸框的版本（多个浏览器连接共享同一份编码结果）
+        out_bytes = _annotated_frame(seq, frame_data, overlay_seq, faces)
+        # 构造MJPEG边界：分段依次输出，不再为每帧拼接一份JPEG大小的新缓冲
+        yield _MJPEG_PREFIX
+        yield out_bytes
+        yield _MJPEG_SUFFIX
 
 
 # 创建Flask应用
 app = Flask(__name__)
 
+# 主页只含一个常量表达式 url_for('video_feed')，首次请求渲染后缓存（同时缓存 gzip 版本）
+_index_html: Optional[bytes] = None
+_index_html_gz: Optional[bytes] = None
+
 @app.route('/')
 def index():
     """主页"""
-    # 使用新版更简洁的前端模板
-    return render_template_string(HTML_TEMPLATE_NEW)
+    global _index_html, _index_html_gz
+    if _index_html is None:
+        # 使用新版更简洁的前端模板
+        _index_html = render_template_string(HTML_TEMPLATE_NEW).encode('utf-8')
+        _index_html_gz = gzip.compress(_index_html)
+    if 'gzip' in request.accept_encodings:
+        resp = Response(_index_html_gz, mimetype='text/html')
+        resp.headers['Content-Encoding'] = 'gzip'
+    else:
+        resp = Response(_index_html, mimetype='text/html')
+    resp.headers['Vary'] = 'Accept-Encoding'
+    # 页面内容在进程生命周期内不变，允许浏览器缓存，刷新时不必重新下载
+    resp.headers['Cache-Control'] = 'public, max-age=3600'
+    return resp
+
+def _set_client_nodelay() -> None:
+    """关闭响应连接的 Nagle 算法，使每个 MJPEG 分段立即发出。
+
+    Flask 内置服务器通过 werkzeug.socket 暴露客户端连接；waitress 默认已开启 TCP_NODELAY，
+    gevent 则在监听套接字上设置（accept 出的连接会继承）。
+    """
+    sock = request.environ.get('werkzeug.socket')
+    if sock is not None:
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
 
 @app.route('/video_feed')
 def video_feed():
     """视频流端点"""
-    return Response(generate_frames(),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
+    _set_client_nodelay()
+    # direct_passthrough：生成器产出的 bytes 原样交给 WSGI 服务器写出，不再逐块做编码转换
+    resp = Response(generate_frames(),
+                    mimetype='multipart/x-mixed-replace; boundary=frame',
+                    direct_passthrough=True)
+    # JPEG 已压缩，且压缩/缓冲会破坏实时流：明确禁止中间层压缩、缓存与缓冲
+    resp.headers['Content-Encoding'] = 'identity'
+    resp.headers['Cache-Control'] = 'no-store'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
 
 @app.route('/faces')
 def faces():
-    """返回已识别人脸列表。"""
+    """返回已识别人脸列表；人脸库未变化时按 If-None-Match 返回 304。"""
     with face_lock:
+        etag = f'{_FACE_DB_EPOCH}-{_face_db_version}'
+        if etag in request.if_none_match:
+            return Response(status=304, headers={'ETag': f'"{etag}"'})
         faces_list = [
             {
                 'id': info['id'],
@@ -948,7 +1162,42 @@ def faces():
             for info in face_db.values()
         ]
     faces_list.sort(key=lambda x: x['last_seen'], reverse=True)
-    return jsonify({'faces': faces_list})
+    if orjson is not None:
+        resp = Response(orjson.dumps({'faces': faces_list}), mimetype='application/json')
+    else:
+        resp = jsonify({'faces': faces_list})
+    resp.set_etag(etag)
+    # 允许缓存但每次都需重新验证：轮询时未变化的列表只返回 304
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+def _jpeg_to_png(data: bytes) -> Optional[bytes]:
+    img = _decode_jpeg(data)
+    if img is None:
+        return None
+    ok, buf = cv2.imencode('.png', img)
+    return buf.tobytes() if ok else None
+
+@app.route('/snapshot_batch')
+def snapshot_batch():
+    """将最近 k 帧（默认全部缓存帧）并行解码为PNG，打包成ZIP返回。"""
+    k = request.args.get('k', SNAPSHOT_RING_SIZE, type=int)
+    with frame_cond:
+        frames = list(_recent_frames)[-max(1, k):]
+    if not frames:
+        return jsonify({'error': 'no frames'}), 404
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED) as zf:
+        # gevent 模式下 ThreadPoolExecutor 的线程也是 greenlet，改用 hub 的原生线程池才能真正并行
+        pngs = (gevent.get_hub().threadpool.imap(_jpeg_to_png, frames) if _GEVENT
+                else _snapshot_pool.map(_jpeg_to_png, frames))
+        for i, png in enumerate(pngs):
+            if png is not None:
+                zf.writestr(f'frame_{i:03d}.png', png)
+    resp = Response(out.getvalue(), mimetype='application/zip')
+    resp.headers['Content-Disposition'] = 'attachment; filename=snapshots.zip'
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
 
 @app.route('/face_thumbnail/<int:face_id>.jpg')
 def face_thumbnail(face_id: int):
@@ -966,17 +1215,29 @@ def face_thumbnail(face_id: int):
     return resp
 
 def main() -> int:
+    global face_dnn_dir, face_yunet_path, use_opencl
     args = parse_args()
+    face_dnn_dir = args.face_dnn
+    face_yunet_path = args.face_yunet
+    if args.opencl:
+        use_opencl = cv2.ocl.haveOpenCL()
+        cv2.ocl.setUseOpenCL(use_opencl)
+        if not use_opencl:
+            print("[WARN] 未检测到可用的 OpenCL 设备，人脸检测使用CPU")
     
     print("ESP32 WiFi摄像头Web显示程序")
     print("=" * 50)
     print(f"TCP监听地址: {args.host}:{args.port}")
     print(f"Web服务端口: {args.web_port}")
+    print(f"JPEG编解码: {'libjpeg-turbo' if _turbo is not None else 'OpenCV'}")
+    if use_opencl:
+        print(f"OpenCL设备: {cv2.ocl.Device.getDefault().name()}")
     
     # 启动TCP图像接收线程
     tcp_thread = threading.Thread(
         target=recv_images_thread, 
-        args=(args.host, args.port, args.timeout),
+        args=(args.host, args.port, args.timeout, args.rcvbuf, args.recv_chunk, args.max_frame_bytes,
+              args.length_prefixed),
         daemon=True
     )
     tcp_thread.start()
@@ -992,7 +1253,22 @@ def main() -> int:
     try:
         # 启动Flask Web服务器
         _init_face_detector()
-        app.run(host='0.0.0.0', port=args.web_port, debug=False, threaded=True)
+        threading.Thread(target=face_detector_loop, daemon=True).start()
+        if args.server == "gevent":
+            from gevent.pywsgi import WSGIServer
+            server = WSGIServer(('0.0.0.0', args.web_port), app)
+            server.init_socket()
+            # accept 出的连接会继承监听套接字的 TCP_NODELAY
+            server.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            server.serve_forever()
+        elif args.server == "waitress":
+            from waitress import serve
+            # send_bytes=1：每写入一帧就立即唤醒 I/O 线程发送，整帧仍是一次大块写；
+            # 若设为 64 KiB，小于该值的帧会滞留在输出缓冲中直到下一帧到来
+            serve(app, host='0.0.0.0', port=args.web_port, threads=args.threads,
+                  send_bytes=1)
+        else:
+            app.run(host='0.0.0.0', port=args.web_port, debug=False, threaded=True)
     except KeyboardInterrupt:
         print("\n[INFO] 程序已退出")
         return 0
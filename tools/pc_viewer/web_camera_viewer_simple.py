@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 r"""
 ESP32 WiFi摄像头Web显示程序 (简化版)
-- 不依赖OpenCV，仅使用Flask和标准库
+- 不依赖OpenCV，仅使用Flask和标准库（若已安装 numpy，则用它向量化查找帧边界）
 - 基于Flask的Web服务器，在浏览器中显示摄像头画面
 - 从TCP连接接收ESP32发送的JPEG图像数据
 - 使用MJPEG流的方式在网页上实时显示
@@ -14,23 +14,43 @@ ESP32 WiFi摄像头Web显示程序 (简化版)
     在浏览器中打开 http://localhost:5000 或 http://your-ip:5000
 """
 
+import sys
+
+# 使用 gevent 服务器时，必须在导入 socket/threading 等模块之前打补丁，
+# 这样接收线程、Condition 等都会变成协作式的 greenlet 实现
+if "--server=gevent" in sys.argv or any(
+        a == "--server" and b == "gevent" for a, b in zip(sys.argv, sys.argv[1:])):
+    from gevent import monkey
+    monkey.patch_all()
+
 import argparse
+import asyncio
 import socket
-import sys
 import time
 import threading
-from typing import Optional
-from queue import Queue, Empty
-import io
-import base64
+from typing import List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from flask import Flask, render_template_string, Response, request
 
-from flask import Flask, render_template_string, Response
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 SOI = b"\xff\xd8"  # JPEG Start Of Image
 EOI = b"\xff\xd9"  # JPEG End Of Image
 
-# 全局变量用于存储最新的图像帧
-frame_queue = Queue(maxsize=10)  # 限制队列大小避免内存溢出
+# MJPEG 分段头/尾
+_MJPEG_PREFIX = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+_MJPEG_SUFFIX = b'\r\n'
+
+# 最新帧单槽：接收线程覆盖写入并递增序号后 notify_all；
+# 每个浏览器连接各自记住已发送的序号，总是拿到最新一帧，而不是队列里最旧的一帧
+frame_cond = threading.Condition()
+_slot_frame: Optional[bytes] = None
+_slot_seq = 0
+_slot_time = 0.0  # 最近一帧到达的时间（time.monotonic）
 
 # HTML模板
 HTML_TEMPLATE = '''
@@ -186,7 +206,7 @@ HTML_TEMPLATE = '''
     <div class="container">
         <h1>🎥 ESP32 WiFi 摄像头实时显示</h1>
         <div class="camera-container">
-            <img id="camera-stream" src="{{ url_for('video_feed') }}" alt="Camera Stream" onclick="toggleFullscreen()">
+            <img id="camera-stream" src="{{ stream_url or url_for('video_feed') }}" alt="Camera Stream" onclick="toggleFullscreen()">
         </div>
         <div id="status" class="status disconnected">⏳ 等待摄像头连接...</div>
         
@@ -215,12 +235,25 @@ HTML_TEMPLATE = '''
 '''
 
 def parse_args() -> argparse.Namespace:
-    parser = argparse.ArgumentParser(description="ESP32 WiFi Camera Web Viewer (Simple Version)")
+    # 禁止选项缩写：是否打 gevent 补丁在导入阶段按完整的 --server 判断，
+    # 若允许 --serv gevent 之类的缩写，会在未打补丁的情况下启动 gevent 服务器
+    parser = argparse.ArgumentParser(description="ESP32 WiFi Camera Web Viewer (Simple Version)", allow_abbrev=False)
     parser.add_argument("--host", default="0.0.0.0", help="TCP监听地址，默认 0.0.0.0")
     parser.add_argument("--port", type=int, default=8000, help="TCP监听端口，需与ESP32固件一致，默认 8000")
     parser.add_argument("--web-port", type=int, default=5000, help="Web服务端口，默认 5000")
     parser.add_argument("--timeout", type=float, default=10.0, help="等待连接超时（秒）")
-    return parser.parse_args()
+    parser.add_argument("--server", choices=("flask", "gevent", "waitress"), default="flask",
+                        help="Web服务器：flask 为每个浏览器连接一个线程；gevent 在单线程事件循环中服务所有连接"
+                             "（需 pip install gevent）；waitress 为生产级线程池服务器（需 pip install waitress），默认 flask")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="waitress 工作线程数，每个浏览器视频流占用一个线程，默认8")
+    parser.add_argument("--stream-port", type=int, default=0,
+                        help="在该端口用 asyncio 直接提供 /video_feed，绕过 WSGI；网页仍由 --web-port 提供。"
+                             "默认 0 表示关闭，不能与 --server gevent 同时使用")
+    args = parser.parse_args()
+    if args.stream_port and args.server == "gevent":
+        parser.error("--stream-port 不能与 --server gevent 同时使用")
+    return args
 
 
 def get_default_ip() -> str:
@@ -261,6 +294,12 @@ def recv_images_thread(host: str, port: int, timeout: float) -> None:
                     conn, addr = s.accept()
                     print(f"[INFO] ESP32已连接：{addr}")
                     
+                    try:
+                        conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_RCVBUF)
+                        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    except OSError as e:
+                        print(f"[WARN] 设置socket选项失败: {e}")
+                    
                     with conn:
                         recv_images_from_connection(conn)
                         
@@ -274,100 +313,197 @@ def recv_images_thread(host: str, port: int, timeout: float) -> None:
             continue
 
 
+RX_BUF_SIZE = 512 * 1024  # 预分配接收缓冲区大小，单帧上限约为 RX_BUF_SIZE - RECV_SIZE
+RECV_SIZE = 64 * 1024  # 单次 recv 大小，100 KB 的帧只需 2 次系统调用
+SOCK_RCVBUF = 1 << 20
+# Linux 收到数据后会退出 quick-ack 模式，需要在每次 recv 后重新开启，避免延迟 ACK 拖慢ESP32发送
+TCP_QUICKACK = getattr(socket, "TCP_QUICKACK", None)  # 仅 Linux
+
+
 def recv_images_from_connection(conn: socket.socket) -> None:
     """从TCP连接接收图像数据"""
     
-    buf = bytearray()
+    # 预分配缓冲区，recv_into 直接写入 [tail, RX_BUF_SIZE)，稳态下不再分配内存。
+    # head 之前的数据已消费；scan 之前的数据已查找过，新数据到达后从 scan 处继续。
+    # 只有尾部空间不足时才把未消费的数据搬回开头
+    rx = bytearray(RX_BUF_SIZE)
+    mv = memoryview(rx)
+    head = tail = 0
+    scan = 0
+    start = -1  # 当前帧 SOI 位置，-1 表示尚未找到
     conn.settimeout(5.0)
     
     while True:
+        if RX_BUF_SIZE - tail < RECV_SIZE:
+            pending = tail - head
+            if pending > RX_BUF_SIZE - RECV_SIZE:
+                # 单帧超过缓冲区，丢弃并重新同步
+                print(f"[WARN] 帧长超过 {RX_BUF_SIZE} 字节，丢弃")
+                head = tail = scan = 0
+                start = -1
+            else:
+                rx[:pending] = rx[head:tail]
+                scan -= head
+                if start >= 0:
+                    start -= head
+                head, tail = 0, pending
         try:
-            data = conn.recv(4096)
-            if not data:
+            n = conn.recv_into(mv[tail:], RECV_SIZE)
+            if not n:
                 print("[INFO] ESP32断开连接")
                 break
-            buf.extend(data)
+            tail += n
+            if TCP_QUICKACK is not None:
+                conn.setsockopt(socket.IPPROTO_TCP, TCP_QUICKACK, 1)
         except socket.timeout:
             continue
         except Exception as e:
             print(f"[ERROR] 接收数据失败: {e}")
             break
 
-        # 查找JPEG帧边界
-        start = buf.find(SOI)
-        if start > 0:
-            del buf[:start]
-        elif start < 0 and len(buf) > 1024 * 1024:
-            buf.clear()
-            continue
-
-        # 提取完整的JPEG帧
+        # 一次找出新数据中全部 SOI/EOI（回退 1 字节，覆盖被 recv 切开的标记），
+        # 再按顺序配对提取完整的JPEG帧
+        sois, eois = scan_markers(rx, max(head, scan - 1), tail)
+        scan = tail
+        si = ei = 0
         while True:
-            start = buf.find(SOI)
             if start < 0:
+                while si < len(sois) and sois[si] < head:
+                    si += 1
+                if si == len(sois):
+                    # 没有 SOI 的数据直接丢弃，只保留可能是半个标记的最后 1 字节
+                    head = max(head, tail - 1)
+                    break
+                start = head = sois[si]
+            while ei < len(eois) and eois[ei] < start + 2:
+                ei += 1
+            if ei == len(eois):
                 break
-            end = buf.find(EOI, start + 2)
-            if end < 0:
-                break
-            end += 2
+            end = eois[ei] + 2
             
-            frame_data = bytes(buf[start:end])
-            del buf[:end]
+            frame_data = bytes(mv[start:end])
+            head = end
+            start = -1
             
-            # 将帧数据放入队列
-            try:
-                frame_queue.put_nowait(frame_data)
-            except:
-                # 队列满时丢弃旧帧
-                try:
-                    frame_queue.get_nowait()
-                    frame_queue.put_nowait(frame_data)
-                except Empty:
-                    pass
-
-
-def create_waiting_image() -> bytes:
-    """创建等待连接的占位图像"""
-    # 创建一个简单的SVG图像作为占位符
-    svg_content = '''<?xml version="1.0" encoding="UTF-8"?>
-<svg width="320" height="240" xmlns="http://www.w3.org/2000/svg">
-    <rect width="320" height="240" fill="#f0f0f0"/>
-    <text x="160" y="120" text-anchor="middle" font-family="Arial" font-size="18" fill="#666">
-        等待ESP32连接...
-    </text>
-    <text x="160" y="150" text-anchor="middle" font-family="Arial" font-size="14" fill="#999">
-        Waiting for ESP32...
-    </text>
-</svg>'''
-    
-    # 由于我们没有图像处理库，返回一个简单的错误信息
-    # 实际上，我们在没有帧时会发送最后一帧或者跳过
-    return b''
+            publish_frame(frame_data)
+
+
+def scan_markers(rx: bytearray, lo: int, hi: int) -> Tuple[List[int], List[int]]:
+    """返回 [lo, hi) 中全部 SOI 与 EOI 的绝对位置（升序）"""
+    if np is not None:
+        # 一次向量化比较同时找出两种标记
+        arr = np.frombuffer(rx, dtype=np.uint8, count=hi - lo, offset=lo)
+        ff = np.flatnonzero(arr[:-1] == 0xFF)
+        nxt = arr[ff + 1]
+        return (ff[nxt == 0xD8] + lo).tolist(), (ff[nxt == 0xD9] + lo).tolist()
+    found = ([], [])
+    for marker, out in zip((SOI, EOI), found):
+        i = rx.find(marker, lo, hi)
+        while i >= 0:
+            out.append(i)
+            i = rx.find(marker, i + 2, hi)
+    return found
+
+
+def publish_frame(frame_data: bytes) -> None:
+    """写入最新帧并唤醒所有等待中的MJPEG连接（旧帧直接被覆盖）。"""
+    global _slot_frame, _slot_seq, _slot_time
+    with frame_cond:
+        _slot_frame = frame_data
+        _slot_seq += 1
+        _slot_time = time.monotonic()
+        frame_cond.notify_all()
+    loop = _stream_loop
+    if loop is not None:
+        loop.call_soon_threadsafe(_wake_stream_clients)
+
+
+# =============== 直连MJPEG流服务器（--stream-port） ===============
+# 绕过 WSGI：HTTP 响应头只写一次，之后每帧一次 writelines（Linux 上为一次 sendmsg）
+_STREAM_PREAMBLE = (b'HTTP/1.1 200 OK\r\n'
+                    b'Content-Type: multipart/x-mixed-replace; boundary=frame\r\n'
+                    b'Cache-Control: no-store\r\n'
+                    b'Connection: close\r\n\r\n')
+_NOT_FOUND = b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+_stream_loop: Optional[asyncio.AbstractEventLoop] = None
+_frame_waiter: Optional["asyncio.Future[None]"] = None  # 每来一帧完成一次并换新，所有客户端共享
+
+
+def _wake_stream_clients() -> None:
+    """在事件循环线程中执行：唤醒所有等待新帧的客户端。"""
+    global _frame_waiter
+    waiter, _frame_waiter = _frame_waiter, _stream_loop.create_future()
+    waiter.set_result(None)
+
+
+async def _serve_stream_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass  # 忽略请求头
+        parts = request_line.split()
+        if len(parts) < 2 or parts[0] != b'GET' or parts[1].split(b'?')[0] != b'/video_feed':
+            writer.write(_NOT_FOUND)
+            await writer.drain()
+            return
+        writer.write(_STREAM_PREAMBLE)
+        while True:
+            # 1 秒内没有新帧时重复发送最后一帧，与 /video_feed 行为一致
+            await asyncio.wait({_frame_waiter}, timeout=1.0)
+            frame = _slot_frame
+            if frame is None:
+                continue
+            # 客户端较慢时 drain 会等待，期间到达的旧帧自然被跳过
+            writer.writelines((_MJPEG_PREFIX, frame, _MJPEG_SUFFIX))
+            await writer.drain()
+    except (ConnectionError, OSError, asyncio.IncompleteReadError):
+        pass
+    except ValueError:
+        # 请求行或请求头超过 StreamReader 的 64 KiB 上限：readline 抛出 ValueError，直接断开
+        pass
+    finally:
+        writer.close()
+
+
+def run_stream_server(port: int) -> None:
+    """在独立线程中运行 asyncio 直连流服务器。"""
+    global _stream_loop, _frame_waiter
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    _frame_waiter = loop.create_future()
+    loop.run_until_complete(asyncio.start_server(_serve_stream_client, '0.0.0.0', port))
+    _stream_loop = loop
+    print(f"[INFO] 直连MJPEG流服务器监听 0.0.0.0:{port}/video_feed")
+    loop.run_forever()
+
+
+def wait_frame(last_seq: int, timeout: float) -> Tuple[Optional[bytes], int]:
+    """等待比 last_seq 更新的帧；超时返回 (None, last_seq)。"""
+    with frame_cond:
+        if not frame_cond.wait_for(lambda: _slot_seq != last_seq, timeout):
+            return None, last_seq
+        return _slot_frame, _slot_seq
 
 
 def generate_frames():
     """生成MJPEG流帧"""
     last_frame = None
+    seq = 0
     
     while True:
-        try:
-            # 从队列获取最新帧
-            frame_data = frame_queue.get(timeout=1.0)
+        # 等待最新帧
+        frame_data, seq = wait_frame(seq, 1.0)
+        if frame_data is not None:
             last_frame = frame_data
-            
-            # 构造MJPEG边界
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_data + b'\r\n')
-                   
-        except Empty:
-            # 队列为空时，如果有最后一帧就重复发送，否则发送空响应
-            if last_frame:
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + last_frame + b'\r\n')
-            else:
-                # 发送一个最小的JPEG头，避免浏览器报错
-                time.sleep(0.1)
-                continue
+        elif last_frame is None:
+            # 尚未收到任何帧，继续等待
+            continue
+        # 1 秒内没有新帧时重复发送最后一帧，避免浏览器判定连接中断
+        
+        # 构造MJPEG边界：分段依次输出，不再为每帧拼接一份JPEG大小的新缓冲
+        yield _MJPEG_PREFIX
+        yield last_frame
+        yield _MJPEG_SUFFIX
 
 
 # 创建Flask应用
@@ -377,27 +513,52 @@ app = Flask(__name__)
 server_info = {
     'host': '0.0.0.0',
     'tcp_port': 8000,
-    'web_port': 5000
+    'web_port': 5000,
+    'stream_port': 0
 }
 
 @app.route('/')
 def index():
     """主页"""
-    return render_template_string(HTML_TEMPLATE, server_info=server_info)
+    stream_url = None
+    if server_info.get('stream_port'):
+        # 视频流改由直连服务器提供：沿用浏览器访问本页所用的主机名
+        hostname = urlsplit('//' + request.host).hostname or 'localhost'
+        if ':' in hostname:
+            hostname = f'[{hostname}]'
+        stream_url = f"http://{hostname}:{server_info['stream_port']}/video_feed"
+    return render_template_string(HTML_TEMPLATE, server_info=server_info, stream_url=stream_url)
+
+def _set_client_nodelay() -> None:
+    """关闭响应连接的 Nagle 算法，使每个 MJPEG 分段立即发出。
+
+    Flask 内置服务器通过 werkzeug.socket 暴露客户端连接；waitress 默认已开启 TCP_NODELAY，
+    gevent 则在监听套接字上设置（accept 出的连接会继承）。
+    """
+    sock = request.environ.get('werkzeug.socket')
+    if sock is not None:
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
 
 @app.route('/video_feed')
 def video_feed():
     """视频流端点"""
+    _set_client_nodelay()
+    # direct_passthrough：生成器产出的 bytes 原样交给 WSGI 服务器写出
     return Response(generate_frames(),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
+                    mimetype='multipart/x-mixed-replace; boundary=frame',
+                    direct_passthrough=True)
 
 @app.route('/status')
 def status():
     """状态检查端点"""
-    queue_size = frame_queue.qsize()
+    with frame_cond:
+        seq, last = _slot_seq, _slot_time
     return {
-        'queue_size': queue_size,
-        'status': 'connected' if queue_size > 0 else 'waiting',
+        'frame_seq': seq,
+        'status': 'connected' if seq and time.monotonic() - last < 2.0 else 'waiting',
         'server_info': server_info
     }
 
@@ -408,7 +569,8 @@ def main() -> int:
     server_info.update({
         'host': args.host,
         'tcp_port': args.port,
-        'web_port': args.web_port
+        'web_port': args.web_port,
+        'stream_port': args.stream_port
     })
     
     print("ESP32 WiFi摄像头Web显示程序 (简化版)")
@@ -424,6 +586,9 @@ def main() -> int:
     )
     tcp_thread.start()
     
+    if args.stream_port:
+        threading.Thread(target=run_stream_server, args=(args.stream_port,), daemon=True).start()
+    
     # 获取本机IP用于显示访问地址
     local_ip = get_default_ip()
     print(f"\n🌐 请在浏览器中访问:")
@@ -434,8 +599,21 @@ def main() -> int:
     print("\n" + "=" * 55)
     
     try:
-        # 启动Flask Web服务器
-        app.run(host='0.0.0.0', port=args.web_port, debug=False, threaded=True)
+        # 启动Web服务器
+        if args.server == "gevent":
+            from gevent.pywsgi import WSGIServer
+            server = WSGIServer(('0.0.0.0', args.web_port), app)
+            server.init_socket()
+            # accept 出的连接会继承监听套接字的 TCP_NODELAY
+            server.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            server.serve_forever()
+        elif args.server == "waitress":
+            from waitress import serve
+            # send_bytes=1：每写入一帧就立即唤醒 I/O 线程发送，避免小帧滞留在输出缓冲中
+            serve(app, host='0.0.0.0', port=args.web_port, threads=args.threads,
+                  send_bytes=1)
+        else:
+            app.run(host='0.0.0.0', port=args.web_port, debug=False, threaded=True)
     except KeyboardInterrupt:
         print("\n[INFO] 程序已退出")
         return 0